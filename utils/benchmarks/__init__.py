@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+r"""
+Benchmarks for u2o.py.
+
+Usage (from the utils directory):
+
+    python -m benchmarks corpus OUTDIR      # write a synthetic usfm bible
+    python -m benchmarks run -o new.json    # time the conversion
+    python -m benchmarks compare old.json new.json
+
+The run command generates a synthetic corpus, then times doconvert for
+each book, each stage of the conversion, how conversion time scales with
+the size of a book, and end-to-end processfiles with 1, 2, 4 and all cpus
+worth of worker processes, along with how long u2o.py takes to start up
+and how much splitting a large book into shards of chapters helps.
+The results are written as json so that two runs can be compared. compare
+exits with a non-zero status when any timing has slowed down by more than
+the regression threshold.
+
+"""
+
+from __future__ import print_function, unicode_literals
+import os.path
+import sys
+
+# u2o.py lives in the directory above this package.
+UTILSDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if UTILSDIR not in sys.path:
+    sys.path.insert(0, UTILSDIR)
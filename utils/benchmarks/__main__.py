@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""Command line interface for the u2o.py benchmarks."""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import sys
+
+from . import compare, corpus, run, verify
+
+
+def listarg(text):
+    """Convert a comma separated list of numbers to a list of ints."""
+    return [int(_) for _ in text.split(",") if _]
+
+
+def featurearg(text):
+    """Convert a comma separated list of corpus features to a list."""
+    features = [_ for _ in text.split(",") if _]
+    for _ in features:
+        if _ not in corpus.FEATURES:
+            raise argparse.ArgumentTypeError("unknown feature: {}".format(_))
+    return features
+
+
+def addcorpusargs(parser):
+    """Add the options that control the synthetic corpus."""
+    parser.add_argument(
+        "--books",
+        help="number of books in the corpus",
+        type=int,
+        default=12,
+    )
+    parser.add_argument(
+        "--chapters", help="chapters per book", type=int, default=20
+    )
+    parser.add_argument(
+        "--verses", help="verses per chapter", type=int, default=25
+    )
+    parser.add_argument(
+        "--features",
+        help="comma separated list of features to use. "
+        "(all but study if not given) "
+        "choices: {}".format(", ".join(corpus.FEATURES)),
+        type=featurearg,
+        default=None,
+    )
+    parser.add_argument(
+        "--seed", help="seed for the random text", type=int, default=1
+    )
+
+
+def getparser():
+    """Build the command line parser."""
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="benchmarks for u2o.py",
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    corpusparser = commands.add_parser(
+        "corpus",
+        help="write a synthetic usfm corpus",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    corpusparser.add_argument("outdir", help="directory for the usfm files")
+    addcorpusargs(corpusparser)
+
+    runparser = commands.add_parser(
+        "run",
+        help="run the benchmarks",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    runparser.add_argument(
+        "-o",
+        help="file to write json results to",
+        default="benchmark.json",
+        metavar="output_file",
+    )
+    runparser.add_argument(
+        "-x", help="disable OSIS validation", action="store_true"
+    )
+    runparser.add_argument(
+        "--repeat",
+        help="times to run each benchmark. the fastest time is kept",
+        type=int,
+        default=3,
+    )
+    runparser.add_argument(
+        "--workers",
+        help="comma separated worker counts for processfiles. "
+        "(1, 2, 4 and the number of cpus if not given)",
+        type=listarg,
+        default=None,
+    )
+    runparser.add_argument(
+        "--scaling",
+        help="comma separated chapter counts for the book size benchmark",
+        type=listarg,
+        default="25,50,100,200",
+    )
+    runparser.add_argument(
+        "--workdir",
+        help="keep the corpus and output in this directory",
+        default=None,
+        metavar="DIR",
+    )
+    addcorpusargs(runparser)
+
+    compareparser = commands.add_parser(
+        "compare",
+        help="compare two benchmark runs",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    compareparser.add_argument("old", help="results of the earlier run")
+    compareparser.add_argument("new", help="results of the later run")
+    compareparser.add_argument(
+        "--threshold",
+        help="slowdown, as a fraction, that counts as a regression",
+        type=float,
+        default=0.1,
+    )
+    compareparser.add_argument(
+        "--minimum",
+        help="ignore differences smaller than this many seconds",
+        type=float,
+        default=0.001,
+    )
+
+    verifyparser = commands.add_parser(
+        "verify",
+        help="check that the output is the same as another copy of u2o.py",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    verifyparser.add_argument(
+        "old", help="the other copy of u2o.py, such as an earlier version"
+    )
+    addcorpusargs(verifyparser)
+    return parser
+
+
+def main():
+    """Run a benchmark command."""
+    parser = getparser()
+    args = parser.parse_args()
+
+    if args.command == "corpus":
+        fnames = corpus.writecorpus(
+            args.outdir,
+            args.books,
+            args.chapters,
+            args.verses,
+            args.features,
+            args.seed,
+        )
+        print("Wrote {} books to {}".format(len(fnames), args.outdir))
+    elif args.command == "run":
+        run.runbenchmarks(args)
+    elif args.command == "compare":
+        if compare.compareresults(
+            args.old, args.new, args.threshold, args.minimum
+        ):
+            sys.exit(1)
+    elif args.command == "verify":
+        if verify.verifyoutput(args.old, args):
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""Compare the results of two benchmark runs."""
+
+from __future__ import print_function, unicode_literals
+import codecs
+import json
+
+
+def readresults(fname):
+    """Read the results of a benchmark run."""
+    with codecs.open(fname, "r", "utf-8") as ifile:
+        return json.load(ifile)
+
+
+def compareresults(oldfile, newfile, threshold=0.1, minimum=0.001):
+    """
+    Print a comparison of two benchmark runs.
+
+    A timing is a regression when it's more than threshold (a fraction)
+    slower than before. Differences smaller than minimum seconds are
+    ignored since they're mostly noise. Returns the number of regressions.
+
+    """
+    old = readresults(oldfile)
+    new = readresults(newfile)
+
+    for key in ["version", "python", "cpus", "validate", "corpus"]:
+        if old["meta"].get(key) != new["meta"].get(key):
+            print(
+                "Note: {} differs: {} -> {}".format(
+                    key, old["meta"].get(key), new["meta"].get(key)
+                )
+            )
+
+    regressions = 0
+    summary = "{:<32} {:>10} {:>10} {:>8}  {}"
+    print(summary.format("benchmark", "old", "new", "change", "").rstrip())
+    for name, newtime in new["timings"].items():
+        if name not in old["timings"]:
+            continue
+        oldtime = old["timings"][name]
+        change = 0.0
+        if oldtime > 0:
+            change = newtime / oldtime - 1
+        regressed = change > threshold and newtime - oldtime > minimum
+        regressions += {True: 1, False: 0}[regressed]
+        print(
+            summary.format(
+                name,
+                "{:.4f}".format(oldtime),
+                "{:.4f}".format(newtime),
+                "{:+.1%}".format(change),
+                {True: "REGRESSION", False: ""}[regressed],
+            ).rstrip()
+        )
+
+    print("{} regression(s) over {:.0%}".format(regressions, threshold))
+    return regressions
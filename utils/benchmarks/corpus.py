@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+r"""
+Generate synthetic usfm books for benchmarking.
+
+The books are random but repeatable for a given seed, and use a mix of the
+markup found in real bibles. Features that can be turned on or off:
+
+    intro       - book introductions with an outline entry for each chapter
+    cl          - a single \cl before the first chapter
+    notes       - footnotes (\f ... \f*)
+    xrefs       - cross references (\x ... \x*)
+    strongs     - \w words with strong's numbers and other attributes
+    poetry      - \q1, \q2, \qs, \d and \b
+    tables      - \tr, \th#, \tc# and \tcr#
+    wj          - words of jesus (\wj ... \wj*)
+    milestones  - quotation milestones (\qt-s ... \qt-e)
+    chars       - \add, \nd and nested character styles
+    lists       - \li1 and \li2
+    ranges      - verse ranges (\v 3-4)
+    study       - several long study bible style notes in every verse
+
+All features except study are used by default.
+
+"""
+
+from __future__ import print_function, unicode_literals
+import codecs
+import os
+import os.path
+import random
+
+# -------------------------------------------------------------------------- #
+
+FEATURES = [
+    "intro",
+    "cl",
+    "notes",
+    "xrefs",
+    "strongs",
+    "poetry",
+    "tables",
+    "wj",
+    "milestones",
+    "chars",
+    "lists",
+    "ranges",
+    "study",
+]
+
+DEFAULTFEATURES = [_ for _ in FEATURES if _ != "study"]
+
+# usfm book ids in canonical order.
+BOOKS = """
+    GEN EXO LEV NUM DEU JOS JDG RUT 1SA 2SA 1KI 2KI 1CH 2CH EZR NEH EST JOB
+    PSA PRO ECC SNG ISA JER LAM EZK DAN HOS JOL AMO OBA JON MIC NAM HAB ZEP
+    HAG ZEC MAL MAT MRK LUK JHN ACT ROM 1CO 2CO GAL EPH PHP COL 1TH 2TH 1TI
+    2TI TIT PHM HEB JAS 1PE 2PE 1JN 2JN 3JN JUD REV
+""".split()
+
+WORDS = """
+    and the LORD said unto him go thou into the land which I will shew thee
+    behold a great fish was prepared to swallow up Jonah in belly of three
+    days nights then prayed out his affliction waters compassed me about
+    even soul depth closed round weeds were wrapped head
+""".split()
+
+# -------------------------------------------------------------------------- #
+
+
+def words(rng, count):
+    """Return some random words."""
+    return " ".join([rng.choice(WORDS) for _ in range(count)])
+
+
+def versetext(rng, features):
+    """Return the text of a verse."""
+    parts = [words(rng, rng.randint(4, 14))]
+    if "chars" in features:
+        if rng.random() < 0.3:
+            parts.append(r"\add {}\add*".format(words(rng, 2)))
+        if rng.random() < 0.2:
+            parts.append(r"\nd LORD\nd*")
+        if rng.random() < 0.1:
+            parts.append(r"\bd bold \+it nested \+nd LORD\+nd* text\+it*\bd*")
+    if "strongs" in features:
+        for _ in range(rng.randint(0, 3)):
+            parts.append(
+                r'\w {}|strong="H{:04d}"\w*'.format(
+                    rng.choice(WORDS), rng.randint(1, 8674)
+                )
+            )
+        if rng.random() < 0.3:
+            parts.append(
+                r'\w {}|lemma="x" strong="G{},G{}" x-morph="V-PAI"\w*'.format(
+                    rng.choice(WORDS),
+                    rng.randint(1, 5624),
+                    rng.randint(1, 5624),
+                )
+            )
+    if "notes" in features and rng.random() < 0.3:
+        parts.append(
+            r"\f + \fr 1:{} \fq {} \fqa {} \ft {}\f*".format(
+                rng.randint(1, 30), words(rng, 2), words(rng, 2), words(rng, 6)
+            )
+        )
+    if "xrefs" in features and rng.random() < 0.25:
+        parts.append(
+            r"\x - \xo 1:{} \xt Gen 1:1; Exod 2:3\x*".format(
+                rng.randint(1, 30)
+            )
+        )
+    if "study" in features:
+        for _ in range(rng.randint(1, 4)):
+            parts.append(studynote(rng))
+    rng.shuffle(parts)
+    return " ".join(parts)
+
+
+def studynote(rng):
+    """Return a footnote or cross reference like those in study bibles."""
+    if rng.random() < 0.3:
+        return (
+            r"\x - \xo 1:{} \xk {} \xq {} \xt Gen 1:1; Exod 2:3\xt* "
+            r"\xot \xt Lev 3:4|link-ref=LEV_3_4\xt*\xot*\x*".format(
+                rng.randint(1, 30), words(rng, 2), words(rng, 3)
+            )
+        )
+    parts = [r"\fr 1:{}".format(rng.randint(1, 30))]
+    for _ in range(rng.randint(2, 6)):
+        kind = rng.choice(["fk", "fq", "fqa", "ft", "ft", "ft"])
+        parts.append(r"\{} {}".format(kind, words(rng, rng.randint(2, 20))))
+    if rng.random() < 0.3:
+        parts.append(r"\fv {}\fv*".format(rng.randint(1, 30)))
+    if rng.random() < 0.5:
+        parts.append(r"\+xt Gen {}:{}\+xt*".format(rng.randint(1, 50), 1))
+    if rng.random() < 0.3:
+        parts.append(r"\+add {}\+add*".format(words(rng, 2)))
+    return r"\f + {}\f*".format(" ".join(parts))
+
+
+def book(bookid, chapters=20, verses=25, features=None, seed=1):
+    """
+    Return the text of a synthetic usfm book.
+
+    The default features are used if features is None.
+
+    """
+    if features is None:
+        features = DEFAULTFEATURES
+    features = set(features)
+    rng = random.Random("{} {}".format(bookid, seed))
+
+    lines = [
+        r"\id {} synthetic benchmark text".format(bookid),
+        r"\ide UTF-8",
+        r"\h {}".format(bookid),
+        r"\toc1 The Book of {}".format(bookid),
+        r"\toc2 {}".format(bookid),
+        r"\toc3 {}".format(bookid[:3]),
+    ]
+    if "intro" in features:
+        lines.extend(
+            [
+                r"\imt1 Introduction",
+                r"\is1 Background",
+                r"\ip This is the \bk Book\bk* of {}. {}".format(
+                    bookid, words(rng, 30)
+                ),
+                r"\ipi {}".format(words(rng, 15)),
+                r"\iot Outline",
+            ]
+        )
+        # the outline has an entry for each chapter.
+        for chapter in range(1, chapters + 1):
+            lines.append(
+                r"\io1 {} \ior {}:1-{}\ior*".format(
+                    words(rng, 3), chapter, verses
+                )
+            )
+            if rng.random() < 0.3:
+                lines.append(r"\io2 {}".format(words(rng, 3)))
+        lines.append(r"\ie")
+    lines.extend([r"\mt1 The Book of {}".format(bookid), r"\mt2 Synthetic"])
+    if "cl" in features:
+        lines.append(r"\cl Chapter")
+
+    for chapter in range(1, chapters + 1):
+        lines.append(r"\c {}".format(chapter))
+        if "poetry" in features and chapter % 3 == 0:
+            lines.append(r"\d For the director")
+        lines.append(r"\s1 {}".format(words(rng, 3)))
+        if rng.random() < 0.3:
+            lines.append(r"\r (Gen 1:1-3)")
+        lines.append(r"\p")
+        verse = 1
+        while verse <= verses:
+            kind = rng.random()
+            if "poetry" in features and kind < 0.25:
+                lines.append(r"\q1")
+                lines.append(
+                    r"\v {} {}".format(verse, versetext(rng, features))
+                )
+                lines.append(r"\q2 {}".format(words(rng, 5)))
+                if rng.random() < 0.2:
+                    lines.append(r"\qs Selah\qs*")
+                if rng.random() < 0.3:
+                    lines.append(r"\b")
+                lines.append(r"\p")
+            elif "wj" in features and kind < 0.45:
+                lines.append(
+                    r"\v {} {} \wj {}\wj*".format(
+                        verse, words(rng, 3), versetext(rng, features)
+                    )
+                )
+                if rng.random() < 0.2:
+                    lines.append(r"\p \wj {}\wj*".format(words(rng, 6)))
+            elif "tables" in features and kind < 0.5:
+                lines.append(r"\v {} {}".format(verse, words(rng, 4)))
+                lines.append(r"\tr \th1 Name \th2 Number")
+                lines.append(
+                    r"\tr \tc1 {} \tcr2 {}".format(
+                        rng.choice(WORDS), rng.randint(1, 1000)
+                    )
+                )
+                lines.append(r"\p")
+            elif "lists" in features and kind < 0.55:
+                lines.append(r"\v {} {}".format(verse, words(rng, 4)))
+                lines.append(r"\li1 {}".format(words(rng, 3)))
+                lines.append(r"\li2 {}".format(words(rng, 3)))
+                lines.append(r"\p")
+            elif "ranges" in features and kind < 0.6 and verse < verses:
+                lines.append(
+                    r"\v {}-{} {}".format(
+                        verse, verse + 1, versetext(rng, features)
+                    )
+                )
+                verse += 1
+            elif "milestones" in features and kind < 0.65:
+                lines.append(
+                    r'\v {0} \qt-s |id="q{1}_{0}" who="Pilate"\*{2} '
+                    r'\qt-e |id="q{1}_{0}"\*'.format(
+                        verse, chapter, words(rng, 4)
+                    )
+                )
+            else:
+                lines.append(
+                    r"\v {} {}".format(verse, versetext(rng, features))
+                )
+            if rng.random() < 0.1:
+                lines.append(r"\p")
+            if rng.random() < 0.05:
+                lines.append(r"\s2 {}".format(words(rng, 2)))
+                lines.append(r"\pi")
+            verse += 1
+
+    return "\n".join(lines) + "\n"
+
+
+def writecorpus(
+    outdir, books=66, chapters=20, verses=25, features=None, seed=1
+):
+    """
+    Write a synthetic usfm bible to outdir.
+
+    The file names are returned in canonical order.
+
+    """
+    try:
+        os.makedirs(outdir)
+    except OSError:
+        pass
+    fnames = []
+    for num, bookid in enumerate(BOOKS[:books]):
+        fname = os.path.join(outdir, "{:02d}{}.usfm".format(num + 1, bookid))
+        with codecs.open(fname, "w", "utf-8") as ofile:
+            ofile.write(book(bookid, chapters, verses, features, seed))
+        fnames.append(fname)
+    return fnames
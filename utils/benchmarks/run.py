@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+"""Time the conversion of a synthetic corpus and write the results as json."""
+
+from __future__ import print_function, unicode_literals
+import codecs
+import datetime
+import json
+import logging
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from collections import OrderedDict
+
+import u2o
+
+from . import UTILSDIR, corpus
+
+# -------------------------------------------------------------------------- #
+
+
+def besttime(func, repeat):
+    """Return the fastest of several timed calls to func."""
+    times = []
+    for _ in range(repeat):
+        starttime = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - starttime)
+    return min(times)
+
+
+def getcpus():
+    """Get the number of cpus."""
+    if u2o.importmultiprocessing():
+        try:
+            return u2o.multiprocessing.cpu_count()
+        except NotImplementedError:
+            pass
+    return 1
+
+
+def getoptions(fnames, args, extra=None):
+    """Get u2o.py command line options for converting our corpus."""
+    argv = ["BENCH", "-o", os.path.join(args.workdir, "bench.osis")]
+    if args.x:
+        argv.append("-x")
+    return u2o.prepareargs(
+        u2o.getparser().parse_args(argv + (extra or []) + fnames)
+    )
+
+
+def readbooks(fnames, options):
+    """Read and decode our usfm files the same way the workers do."""
+    texts = []
+    for fname in fnames:
+        with open(fname, "rb") as ifile:
+            texts.append(u2o.decodeusfm(ifile.read(), fname, options.e))
+    return texts
+
+
+def timedoconvert(timings, fnames, options, args):
+    """Time doconvert for each book and for the whole corpus."""
+    total = 0.0
+    for fname, text in zip(fnames, readbooks(fnames, options)):
+        seconds = besttime(lambda: u2o.doconvert((text, options)), args.repeat)
+        timings["doconvert/{}".format(os.path.basename(fname)[2:5])] = seconds
+        total += seconds
+    timings["doconvert"] = total
+
+
+def timescaling(timings, options, args):
+    """Time doconvert for books of increasing size."""
+    for chapters in args.scaling:
+        text = corpus.book(
+            "PSA", chapters, args.verses, args.features, args.seed
+        ).strip()
+        timings["scaling/{}".format(chapters)] = besttime(
+            lambda: u2o.doconvert((text, options)), args.repeat
+        )
+
+
+def timemicro(timings, args):
+    """Time single stages on text that makes heavy use of what they handle."""
+    # note heavy lines, such as those in study bibles.
+    lines = [
+        _
+        for _ in u2o.reflow(
+            corpus.book("GEN", 10, args.verses, ["study"], args.seed).strip()
+        ).split("\n")
+        if r"\f " in _ or r"\x " in _
+    ]
+    timings["micro/c2o_noterefmarkers"] = besttime(
+        lambda: [u2o.c2o_noterefmarkers(_) for _ in lines], args.repeat
+    )
+
+    # every line of an ordinary book.
+    lines = u2o.reflow(
+        corpus.book("PSA", 10, args.verses, args.features, args.seed).strip()
+    ).split("\n")
+    timings["micro/c2o_titlepar"] = besttime(
+        lambda: [u2o.c2o_titlepar(_, "Ps") for _ in lines], args.repeat
+    )
+
+    # a gospel with words of Jesus in paragraphs, poetry and titles.
+    lines = u2o.reflow(
+        corpus.book(
+            "MAT", 10, args.verses, ["wj", "poetry"], args.seed
+        ).strip()
+    ).split("\n")
+    lines = [u2o.c2o_titlepar(_, "Matt") for _ in lines]
+    timings["micro/c2o_processwj2"] = besttime(
+        lambda: u2o.c2o_processwj2(lines), args.repeat
+    )
+
+
+def timeprocessfiles(timings, fnames, args):
+    """Time end-to-end conversion with different numbers of workers."""
+    for workers in args.workers:
+        options = getoptions(fnames, args, ["-j", str(workers)])
+        timings["processfiles/j{}".format(workers)] = besttime(
+            lambda: u2o.processfiles(options), args.repeat
+        )
+
+
+def timesharding(timings, args):
+    """
+    Time a conversion that's held up by one large book.
+
+    This is a 150 chapter Psalms along with a few ordinary books,
+    converted with all of the worker processes, with and without
+    splitting Psalms into shards of chapters.
+
+    """
+    usfmdir = os.path.join(args.workdir, "sharding")
+    fnames = corpus.writecorpus(
+        usfmdir, 3, args.chapters, args.verses, args.features, args.seed
+    )
+    fname = os.path.join(usfmdir, "19PSA.usfm")
+    with codecs.open(fname, "w", "utf-8") as ofile:
+        ofile.write(
+            corpus.book("PSA", 150, args.verses, args.features, args.seed)
+        )
+    fnames.append(fname)
+
+    workers = max(args.workers)
+    for name, extra in [
+        ("sharding/j{}".format(workers), []),
+        ("sharding/j{}/shard".format(workers), ["--shard", "10"]),
+    ]:
+        options = getoptions(fnames, args, ["-j", str(workers)] + extra)
+        timings[name] = besttime(
+            lambda: u2o.processfiles(options), args.repeat
+        )
+
+
+def importtime(repeat):
+    """
+    Get the fastest time to import u2o.py in a new interpreter.
+
+    This uses the numbers from python -X importtime, which leaves out the
+    time taken to start python itself.
+
+    """
+    times = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-X", "importtime", "-c", "import u2o"],
+            cwd=UTILSDIR,
+            stderr=subprocess.STDOUT,
+        ).decode("utf-8")
+        for line in output.split("\n"):
+            parts = [_.strip() for _ in line.split("|")]
+            # import time: self [us] | cumulative | imported package
+            if len(parts) == 3 and parts[2] == "u2o":
+                times.append(int(parts[1]) / 1000000.0)
+    return min(times)
+
+
+def timestartup(timings, fnames, args):
+    """Time starting u2o.py in a new interpreter."""
+    timings["startup/import"] = importtime(args.repeat)
+    script = os.path.join(UTILSDIR, "u2o.py")
+    timings["startup/help"] = besttime(
+        lambda: subprocess.check_output([sys.executable, script, "--help"]),
+        args.repeat,
+    )
+    argv = [sys.executable, script, "BENCH", "-o"]
+    argv.append(os.path.join(args.workdir, "startup.osis"))
+    if args.x:
+        argv.append("-x")
+    timings["startup/onebook"] = besttime(
+        lambda: subprocess.check_output(
+            argv + fnames[-1:], stderr=subprocess.STDOUT
+        ),
+        args.repeat,
+    )
+
+
+def timestages(timings, fnames, args):
+    """
+    Time each stage of the conversion.
+
+    This uses the same profiling as the --profile option of u2o.py. The
+    stages stay wrapped for profiling afterwards, so this is done last.
+
+    """
+    options = getoptions(fnames, args, ["-j", "1"])
+    best = {}
+    for _ in range(args.repeat):
+        u2o.enableprofiling()
+        u2o.processfiles(options)
+        for name, (_calls, seconds) in u2o.PROFILE.items():
+            best[name] = min(best.get(name, seconds), seconds)
+    for name in sorted(best, key=lambda _: -best[_]):
+        timings["stage/{}".format(name)] = best[name]
+
+
+def runbenchmarks(args):
+    """Run the benchmarks and write the results to args.o."""
+    cleanup = args.workdir is None
+    if cleanup:
+        args.workdir = tempfile.mkdtemp(prefix="u2obench")
+    if args.workers is None:
+        args.workers = sorted(set([1, 2, 4, getcpus()]))
+    if args.features is None:
+        args.features = corpus.DEFAULTFEATURES
+
+    # keep the output of u2o.py quiet while we time it.
+    loglevel = u2o.LOG.level
+    u2o.LOG.setLevel(logging.ERROR)
+    try:
+        print("Writing corpus to {}...".format(args.workdir))
+        fnames = corpus.writecorpus(
+            os.path.join(args.workdir, "usfm"),
+            args.books,
+            args.chapters,
+            args.verses,
+            args.features,
+            args.seed,
+        )
+        options = getoptions(fnames, args)
+
+        timings = OrderedDict()
+        print("Timing doconvert...")
+        timedoconvert(timings, fnames, options, args)
+        print("Timing scaling...")
+        timescaling(timings, options, args)
+        print("Timing single stages...")
+        timemicro(timings, args)
+        print("Timing processfiles...")
+        timeprocessfiles(timings, fnames, args)
+        print("Timing sharding...")
+        timesharding(timings, args)
+        print("Timing startup...")
+        timestartup(timings, fnames, args)
+        print("Timing stages...")
+        timestages(timings, fnames, args)
+    finally:
+        u2o.LOG.setLevel(loglevel)
+        if cleanup:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    results = OrderedDict(
+        [
+            (
+                "meta",
+                OrderedDict(
+                    [
+                        ("date", datetime.datetime.now().isoformat()),
+                        ("version", u2o.META["VERSION"]),
+                        ("python", platform.python_version()),
+                        ("implementation", platform.python_implementation()),
+                        ("platform", platform.platform()),
+                        ("cpus", getcpus()),
+                        ("lxml", u2o.importlxml()),
+                        ("validate", not args.x),
+                        ("repeat", args.repeat),
+                        (
+                            "corpus",
+                            OrderedDict(
+                                [
+                                    ("books", args.books),
+                                    ("chapters", args.chapters),
+                                    ("verses", args.verses),
+                                    ("features", list(args.features)),
+                                    ("seed", args.seed),
+                                ]
+                            ),
+                        ),
+                    ]
+                ),
+            ),
+            ("timings", timings),
+        ]
+    )
+    with codecs.open(args.o, "w", "utf-8") as ofile:
+        json.dump(results, ofile, indent=2)
+
+    summary = "{:<32} {:>10}"
+    print(summary.format("benchmark", "seconds"))
+    for name, seconds in timings.items():
+        print(summary.format(name, "{:.4f}".format(seconds)))
+    print("Results written to {}".format(args.o))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""Check that u2o.py converts a synthetic corpus the same as another copy."""
+
+from __future__ import print_function, unicode_literals
+import importlib.util
+import os.path
+import sys
+
+import u2o
+
+from . import corpus
+
+
+def loadmodule(fname):
+    """Load another copy of u2o.py without replacing the one we have."""
+    name = "u2o_{}".format(abs(hash(os.path.abspath(fname))))
+    spec = importlib.util.spec_from_file_location(name, fname)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def firstdifference(old, new):
+    """Get the first line that differs between two texts."""
+    oldlines = (old or "").split("\n")
+    newlines = (new or "").split("\n")
+    for num, (oldline, newline) in enumerate(zip(oldlines, newlines)):
+        if oldline != newline:
+            return num + 1, oldline, newline
+    num = min(len(oldlines), len(newlines))
+    return (
+        num + 1,
+        "".join(oldlines[num : num + 1]),
+        "".join(newlines[num : num + 1]),
+    )
+
+
+def verifyoutput(oldfile, args):
+    """
+    Convert the corpus with both copies of u2o.py and compare the results.
+
+    Both copies must take the same arguments for doconvert. Books are
+    converted with the default options and again without pretty printing,
+    since only one copy of the osis is returned for each. Returns the
+    number of books that differ.
+
+    """
+    old = loadmodule(oldfile)
+    # the default options. (the file name isn't used.)
+    options = u2o.getparser().parse_args(["VERIFY", oldfile])
+    options.x = not u2o.importlxml()
+    if args.features is None:
+        args.features = corpus.FEATURES
+
+    differences = 0
+    for bookid in corpus.BOOKS[: args.books]:
+        text = corpus.book(
+            bookid, args.chapters, args.verses, args.features, args.seed
+        ).strip()
+        oldresults = old.doconvert((text, options)) + old.doconvert(
+            (text, u2o.plainoptions(options))
+        )
+        newresults = u2o.doconvert((text, options)) + u2o.doconvert(
+            (text, u2o.plainoptions(options))
+        )
+        if tuple(oldresults) == tuple(newresults):
+            continue
+        differences += 1
+        for name, oldpart, newpart in zip(
+            ["book id", "description", "osis", "pretty osis", "errors"] * 2,
+            oldresults,
+            newresults,
+        ):
+            if oldpart != newpart:
+                if name == "errors":
+                    oldpart, newpart = str(oldpart), str(newpart)
+                num, oldline, newline = firstdifference(oldpart, newpart)
+                print("{}: {} differs at line {}".format(bookid, name, num))
+                print("    old: {}".format(oldline))
+                print("    new: {}".format(newline))
+                break
+
+    print(
+        "{} of {} books differ".format(
+            differences, len(corpus.BOOKS[: args.books])
+        )
+    )
+    return differences
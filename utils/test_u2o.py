@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for u2o.py. Run with python -m unittest from this directory."""
+
+from __future__ import print_function, unicode_literals
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import u2o
+
+# -------------------------------------------------------------------------- #
+
+BOOK = "\n".join(
+    [
+        r"\id JON Test",
+        r"\h Jonah",
+        r"\c 1",
+        r"\p",
+        r"\v 1 The word of the LORD came to Jonah.",
+        r"\v 2 Get up! Go to the great city of Nineveh.",
+    ]
+)
+
+
+def getoptions(argv):
+    """Get u2o.py options for converting books without any files."""
+    args = u2o.getparser().parse_args(["TEST"] + argv + ["FILE"])
+    args.file = []
+    return u2o.prepareargs(args)
+
+
+class TestBookCache(unittest.TestCase):
+    """Tests for the book cache."""
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp(prefix="u2otest")
+        self.loglevel = u2o.LOG.level
+        u2o.LOG.setLevel(logging.ERROR)
+
+    def tearDown(self):
+        u2o.LOG.setLevel(self.loglevel)
+        shutil.rmtree(self.cachedir, ignore_errors=True)
+
+    def cachedbooks(self):
+        """Get the names of the cached books."""
+        return os.listdir(os.path.join(self.cachedir, "books"))
+
+    def test_prune_keeps_books_used_by_this_run(self):
+        options = getoptions(["-x", "--cache", self.cachedir])
+        stats = u2o.converttext((0, BOOK, "test", options))[1]
+        self.assertEqual(stats[0], "miss")
+        self.assertEqual(len(self.cachedbooks()), 1)
+
+        # a later run that only reads the cached book. (the pause lets the
+        # clock used for file times fall behind, as it does between runs.)
+        time.sleep(0.05)
+        starttime = time.time()
+        stats = u2o.converttext((0, BOOK, "test", options))[1]
+        self.assertEqual(stats[0], "hit")
+        u2o.prunecache(self.cachedir, 0, starttime)
+        self.assertEqual(len(self.cachedbooks()), 1)
+
+        # books that weren't used since then are removed.
+        u2o.prunecache(self.cachedir, 0, time.time() + 1)
+        self.assertEqual(self.cachedbooks(), [])
+
+
+class TestVerses(unittest.TestCase):
+    """Tests for the verse table."""
+
+    def getverses(self, text):
+        """Convert a book and get the plain text of each verse."""
+        options = u2o.plainoptions(getoptions([]))
+        osis = u2o.doconvert((text, options))[2]
+        return [(_[2], _[3]) for _ in u2o.bookverses(osis)]
+
+    def test_heading_is_not_part_of_verse(self):
+        # the end of verse 1 is put after the section title when it's
+        # followed by a parallel passage reference.
+        text = "\n".join(
+            [
+                r"\id JON Test",
+                r"\c 1",
+                r"\p",
+                r"\v 1 The word of the LORD came to Jonah.",
+                r"\s1 The Great Storm",
+                r"\r (Acts 27:13-26)",
+                r"\p",
+                r"\v 2 Then the LORD hurled a great wind upon the sea.",
+            ]
+        )
+        self.assertEqual(
+            self.getverses(text),
+            [
+                ("1", "The word of the LORD came to Jonah."),
+                ("2", "Then the LORD hurled a great wind upon the sea."),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
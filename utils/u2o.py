@@ -43,6 +43,75 @@ Alternative Book Ordering:
     NOTE: I should probably change this so that there's a more central
           location for these alternative book orderings.
 
+Batch Conversion:
+    Several works can be converted in a single run by listing them in a
+    TOML, JSON, or CSV manifest and running:
+
+        u2o.py batch manifest.toml
+
+    A single worker pool and a single copy of the compiled OSIS schema are
+    shared by all of the works, and a summary of the time taken for each
+    work is printed at the end. Example TOML manifest:
+
+        [[work]]
+        workid = "KJV"
+        lang = "en"
+        files = "kjv/*.usfm"
+        sort = "canonical"
+        output = "kjv.osis.xml"
+
+Conversion Cache:
+    When a cache directory is given with --cache the results of converting
+    each book are stored there, keyed by a hash of the contents of the usfm
+    file, a hash of this script, and the options that change the output.
+    Books that haven't changed since an earlier run are not converted
+    again, and changes to this script make it convert every book again.
+    Cache statistics are shown with -v, and cached books that haven't been
+    used for a number of days can be removed with --prune DAYS.
+
+Verse Tables:
+    A table of verses can be written for loading into a database with
+    --verses FILE, where FILE ends with .jsonl, .tsv, or .sqlite. Each row
+    has the work id, osis book id, chapter, verse, and the plain text of
+    the verse, and the osis markup of the verse with --verse-markup. The
+    table is taken from the converted books before they're put together
+    into an osis doc, so --verses-only can be used to skip writing,
+    validating, and reformatting the osis doc. Works written to the same
+    SQLite file are kept in one verses table.
+
+Watch Mode:
+    With --watch the script keeps running after the first conversion and
+    checks the input files for changes. Only the books that changed are
+    converted again, and the osis file is rewritten using the books that
+    are kept in memory for everything else. A book that can't be converted
+    is reported, and the last version of it that could be is kept until it's
+    saved again. Press ctrl-c to stop.
+
+Library Use:
+    Other programs can import this script and convert books in memory with
+    the Converter class. Books are given as bytes or strings and the osis
+    doc is returned as a string. Options are the same as on the command
+    line, and ValueError is raised if they aren't valid. Example:
+
+        import u2o
+
+        with u2o.Converter(["-l", "en"]) as converter:
+            osis = converter.convert("KJV", [genesis, exodus])
+            fragments = converter.fragments([genesis])
+
+Conversion Server:
+    Programs that aren't written in python, or that convert books many
+    times an hour, can use a long running server instead:
+
+        u2o.py serve --port 8390
+        u2o.py serve --socket /tmp/u2o.sock
+
+    The server starts its worker processes and compiles the OSIS schema
+    once. Books are sent as json with a POST to /convert and the osis doc
+    is returned. Requests that can't be converted right away wait in a
+    queue of limited size, and GET /stats returns the queue depth and
+    latency counters. See "u2o.py serve --help" for details.
+
 This script has been tested and is known to work with CPython 3.4.0,
 CPython 2.7.6, jython 2.7.0, pypy 2.5.0, and pypy3 2.4.0.
 
@@ -83,32 +152,25 @@ import os
 import os.path
 import glob
 import re
+import signal
+import threading
 import codecs
 import datetime
 import unicodedata
 import logging
+import json
+import hashlib
+import csv
+import time
+import timeit
 from collections import OrderedDict
 from contextlib import closing
 
-# try to import multiprocessing
-# (jython 2.7.0 doesn't have this module.)
-HAVEMULTIPROCESSING = False
-try:
-    import multiprocessing
-
-    HAVEMULTIPROCESSING = True
-except ImportError:
-    pass
-
-# try to import lxml so that we can validate
-# our output against the OSIS schema.
-HAVELXML = False
-try:
-    import lxml.etree as et
-
-    HAVELXML = True
-except ImportError:
-    pass
+# multiprocessing and lxml take a while to import, so they're imported the
+# first time that they're needed. These are None until then, and True or
+# False afterwards. (see importmultiprocessing and importlxml)
+HAVEMULTIPROCESSING = None
+HAVELXML = None
 
 # -------------------------------------------------------------------------- #
 
@@ -150,6 +212,21 @@ OSISFOOTER = """
     </osisText>
 </osis>\n"""
 
+# used to wrap parts of an osis doc while they're being formatted.
+OSISWRAPPER = (
+    '<osis xmlns="http://www.bibletechnologies.net/2003/OSIS/namespace">'
+    "<osisText>",
+    "</osisText></osis>",
+)
+
+# minimal osis document used to validate books on their own.
+OSISENVELOPE = (
+    '<osis xmlns="http://www.bibletechnologies.net/2003/OSIS/namespace">'
+    '<osisText osisIDWork="u2o" osisRefWork="Bible" xml:lang="und">'
+    '<header><work osisWork="u2o"/></header>',
+    "</osisText></osis>",
+)
+
 # -------------------------------------------------------------------------- #
 
 CANONICALORDER = [
@@ -272,18 +349,6 @@ CANONICALORDER = [
     "GAZETTEER",
     "X-OTHER",
 ]
-# get list of book orders available from external files in the current
-# working directory.  Each order file has the following naming pattern:
-#    order-SOMEORDER.txt
-BOOKORDERS = sorted(
-    [
-        _.replace("order-", "").replace(".txt", "")
-        for _ in glob.glob("order-*.txt")
-    ]
-)
-BOOKORDERS.append("none")
-BOOKORDERS.insert(0, "canonical")
-
 # -------------------------------------------------------------------------- #
 
 # convert usfm book names
@@ -595,6 +660,24 @@ TITLETAGS = {
     ),
 }
 
+# peripheral and private use books also have periph titles. These books get
+# their own copy of the title tags so that TITLETAGS is never changed.
+PERIPHBOOKS = [
+    "FRONT",
+    "INTRODUCTION",
+    "BACK",
+    "X-OTHER",
+    "XXA",
+    "XXB",
+    "XXC",
+    "XXD",
+    "XXE",
+    "XXF",
+    "XXG",
+]
+PERIPHTITLETAGS = dict(TITLETAGS)
+PERIPHTITLETAGS[r"\periph"] = ('<title type="main">', "</title>")
+
 # paragraph and poetry/prose tags
 PARTAGS = {
     # INTRODUCTIONS
@@ -960,38 +1043,63 @@ DEFAULTATTRIBUTES = {r"\w": "lemma", r"\xt": "link-ref"}
 # -------------------------------------------------------------------------- #
 # REGULAR EXPRESSIONS
 
+
+class LazyRegex(object):
+    """
+    A regular expression that is compiled the first time it's used.
+
+    Most of our regular expressions are large, and compiling all of them
+    would make up a good part of the time it takes to start this script.
+
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self.regex = None
+
+    def __getattr__(self, name):
+        # only called for attributes we don't have yet. The attributes of
+        # the compiled regex are copied here so that this is called only
+        # once for each of them.
+        if self.regex is None:
+            self.regex = re.compile(self.pattern, self.flags)
+        value = getattr(self.regex, name)
+        setattr(self, name, value)
+        return value
+
+
 # squeeze all regular spaces, carriage returns, and newlines
 # into a single space.
-SQUEEZE = re.compile(r"[ \t\n\r]+", re.U + re.M + re.DOTALL)
+SQUEEZE = LazyRegex(r"[ \t\n\r]+", re.U + re.M + re.DOTALL)
 
-# matches special text and character styles
+# matches special text and character style markers.
 # Automatically build SPECIALTEXTRE regex string from SPECIALTEXT dict.
 SPECIALTEXTRE_S = r"""
-        # put special text tags into a named group called 'tag'
-        (?P<tag>
-
-            # tags always start with a backslash and may have a + symbol which
-            # indicates that it's a nested character style.
-            \\\+?
+        # put the marker into a group so that re.split keeps it.
+        (
+            # markers always start with a backslash.
+            \\
 
-            # match the tags we want to match.
+            # match the tags we want to match. Nested character styles have a
+            # + symbol. Longer tags are listed first so that a tag that is the
+            # start of another one, such as bd and bdit, is never matched on
+            # its own.
             (?:{})
-        )
-
-        # there is always at least one space separating the tag and the content
-        \s+
 
-        # put the tag content into a named group called 'osis'
-        (?P<osis>.*?)
-
-        # tag end marker
-        (?P=tag)\*
+            # end markers have an asterisk. There is always at least one space
+            # separating a start marker and the content.
+            (?:\*|\s+)
+        )
     """.format(
     "|".join(
-        [_.replace("\\", "") for _ in SPECIALTEXT if not _.startswith(r"\+")]
+        [
+            re.escape(_[1:])
+            for _ in sorted(SPECIALTEXT, key=lambda _: (-len(_), _))
+        ]
     )
 )
-SPECIALTEXTRE = re.compile(SPECIALTEXTRE_S, re.U + re.VERBOSE)
+SPECIALTEXTRE = LazyRegex(SPECIALTEXTRE_S, re.U + re.VERBOSE)
 del SPECIALTEXTRE_S
 
 # match z tags that have both a start and end marker
@@ -1015,7 +1123,7 @@ ZTAGS_S = r"""
         # tag end marker
         (?P=tag)\*
     """
-ZTAGSRE = re.compile(ZTAGS_S, re.U + re.VERBOSE)
+ZTAGSRE = LazyRegex(ZTAGS_S, re.U + re.VERBOSE)
 del ZTAGS_S
 
 # matches special feature tags
@@ -1046,7 +1154,7 @@ SPECIALFEATURESRE_S = r"""
         [_.replace("\\", "") for _ in FEATURETAGS if not _.startswith(r"\+")]
     )
 )
-SPECIALFEATURESRE = re.compile(SPECIALFEATURESRE_S, re.U + re.VERBOSE)
+SPECIALFEATURESRE = LazyRegex(SPECIALFEATURESRE_S, re.U + re.VERBOSE)
 del SPECIALFEATURESRE_S
 
 # regex used in footnote/crossref functions
@@ -1082,12 +1190,23 @@ NOTERE_S = r"""
         [_.replace("\\", "") for _ in NOTETAGS if not _.startswith(r"\+")]
     )
 )
-NOTERE = re.compile(NOTERE_S, re.U + re.VERBOSE)
+NOTERE = LazyRegex(NOTERE_S, re.U + re.VERBOSE)
 del NOTERE_S
 # ---
 # Automatically build NOTEFIXRE regex string from NOTETAGS2 dict.
 NOTEFIXRE_S = r"""
-        (
+        # end markers for the footnote/crossref specific usfm tags are put
+        # into a named group called 'end' so that they can be removed.
+        # (xop and xta end markers are left alone.)
+        (?P<end>
+            \\\+?
+            (?:{})
+            \*
+        )
+        |
+        # put the footnote/crossref specific usfm tags into a named group
+        # called 'tag'
+        (?P<tag>
             # tags always start with a backslash and may have a + symbol which
             # indicates that it's a nested character style.
             \\\+?
@@ -1101,21 +1220,28 @@ NOTEFIXRE_S = r"""
         \s+
 
         # This matches the content of the tag
-        (.*?)
+        (?P<osis>.*?)
 
         # This marks the end of the tag. It matches against either the
         # start of an additional tag or the end of the note.
         (?=\\\+?[fx]|</note)
     """.format(
+    "|".join(
+        [
+            _.replace("\\", "")
+            for _ in NOTETAGS2
+            if not _.startswith(r"\+") and _ not in [r"\xop", r"\xta"]
+        ]
+    ),
     "|".join(
         [_.replace("\\", "") for _ in NOTETAGS2 if not _.startswith(r"\+")]
-    )
+    ),
 )
-NOTEFIXRE = re.compile(NOTEFIXRE_S, re.U + re.VERBOSE)
+NOTEFIXRE = LazyRegex(NOTEFIXRE_S, re.U + re.VERBOSE)
 del NOTEFIXRE_S
 
 # match \cp and \vp tags
-CPRE = re.compile(
+CPRE = LazyRegex(
     r"""
         \\(?:cp)
         \s+
@@ -1124,7 +1250,7 @@ CPRE = re.compile(
     """,
     re.U + re.VERBOSE,
 )
-VPRE = re.compile(
+VPRE = LazyRegex(
     r"""
         \\(?:vp)
         \s+
@@ -1137,7 +1263,7 @@ VPRE = re.compile(
 )
 
 # regex for matching against \ca or \va usfm tags.
-CVARE = re.compile(
+CVARE = LazyRegex(
     r"""
         # put the tag we match into a named group called tag
         (?P<tag>
@@ -1165,7 +1291,7 @@ CVARE = re.compile(
 )
 
 # regex for finding usfm tags
-USFMRE = re.compile(
+USFMRE = LazyRegex(
     r"""
     # the first character of a usfm tag is always a backslash
     \\
@@ -1191,7 +1317,28 @@ USFMRE = re.compile(
 )
 
 
-ATTRIBRE = re.compile(r' +(\S+=[\'"])', re.U + re.DOTALL)
+ATTRIBRE = LazyRegex(r' +(\S+=[\'"])', re.U + re.DOTALL)
+
+# finds the usfm markers in a line, which decide the stages it needs.
+USFMLEXRE = LazyRegex(
+    r"""
+    # the first character of a usfm marker is always a backslash
+    \\
+
+    # a plus symbol marks the start of a nested character style.
+    # this may or may not be present.
+    \+?
+
+    # marker names are ascii letters, numbers, and hyphens. (milestones
+    # such as \qt-s use hyphens.) The name may be empty for the
+    # milestone end marker \*
+    [A-Za-z0-9-]*
+
+    # closing markers end with an asterisk.
+    \*?
+""",
+    re.U + re.VERBOSE,
+)
 
 
 # -------------------------------------------------------------------------- #
@@ -1214,10 +1361,99 @@ for _ in [r"\iex", r"\ie", r"\qa"]:
     except KeyError:
         pass
 
+# regular expressions built from the tag sets above so that reflow can find
+# all of the tags it's looking for in a single pass over the text. longer
+# tags are listed first so the regex engine rarely needs to backtrack.
+PARFLOWRE = LazyRegex(
+    r"\\(?:{}) ".format(
+        "|".join(
+            [
+                re.escape(_[1:])
+                for _ in sorted(PARFLOW, key=lambda _: (-len(_), _))
+            ]
+        )
+    ),
+    re.U,
+)
+PARCHECKRE = LazyRegex(
+    r"\\(?:{})\b".format(
+        "|".join(
+            [
+                re.escape(_[1:])
+                for _ in sorted(PARCHECK, key=lambda _: (-len(_), _))
+            ]
+        )
+    ),
+    re.U,
+)
+
+# other title, paragraph, and intro tags. (the order of OTHERTAGS is kept)
+OTHERTAGSRE = LazyRegex(
+    "|".join([re.escape(_) for _ in OTHERTAGS.keys()]), re.U
+)
+
 # title tags... used by reflow subroutine below.
 # use TITLETAGS keys to eliminate unnecessary duplication
 TITLEFLOW = set(TITLETAGS.keys())
 
+# -------------------------------------------------------------------------- #
+# VARIABLES USED BY WORDS OF JESUS ROUTINE
+
+# q tags for the words of Jesus are closed before the end tags of titles and
+# paragraphs, and opened again after their start tags.
+WJSTARTTAGS = set()
+WJENDTAGS = set()
+for _ in list(TITLETAGS.values()) + list(PARTAGS.values()):
+    if _[0] != "" and _[1] != "":
+        WJSTARTTAGS.add(_[0].strip())
+        WJENDTAGS.add(_[1].strip())
+
+# some end tags contain others, such as </l> in </l>\ufdd0</lg>. the
+# longest tags are tried first so that each one is only found once.
+WJTAGSRE = LazyRegex(
+    "|".join(
+        [
+            re.escape(_)
+            for _ in sorted(
+                WJSTARTTAGS | WJENDTAGS, key=lambda _: (-len(_), _)
+            )
+        ]
+    ),
+    re.U,
+)
+
+# -------------------------------------------------------------------------- #
+# VARIABLES USED FOR VERSE TABLES
+
+# matches the text between the start and end of each verse in a book.
+VERSERE = LazyRegex(
+    r'<verse sID="(?P<id>[^"]+)"[^>]*/>'
+    r'(?P<markup>.*?)<verse eID="(?P=id)"\s*/>',
+    re.U + re.DOTALL,
+)
+
+# matches comments, notes, speakers and headings, which aren't part of the
+# text of a verse. Headings such as section titles can be found inside a
+# verse when they come before the end of it. (canonical titles, such as
+# psalm titles, are part of the text.)
+VERSENOTESRE = LazyRegex(
+    r"<!--.*?-->|<note\b.*?</note>|<speaker\b.*?</speaker>"
+    r'|<title\b(?![^>]*canonical="true")[^>]*(?<!/)>.*?</title>',
+    re.U + re.DOTALL,
+)
+
+# matches osis tags.
+OSISTAGRE = LazyRegex(r"<[^>]*>", re.U)
+
+# verse table formats for each file extension.
+VERSEFORMATS = {
+    ".jsonl": "jsonl",
+    ".tsv": "tsv",
+    ".sqlite": "sqlite",
+    ".sqlite3": "sqlite",
+    ".db": "sqlite",
+}
+
 # -------------------------------------------------------------------------- #
 # VARIABLES USED BY POSTPROCESS ROUTINE
 
@@ -1232,6 +1468,18 @@ for _ in PARTAGS:
 OSISL.add("<l>")
 OSISITEM.add("<item>")
 
+# -------------------------------------------------------------------------- #
+# VARIABLES USED BY CONVERT_TO_OSIS ROUTINE
+
+# special text markers, including their nested and closing forms.
+SPECIALTEXTMARKERS = set()
+for _ in SPECIALTEXT:
+    SPECIALTEXTMARKERS.update([_, "{}*".format(_)])
+
+# footnote, cross reference, and study bible category markers all
+# start with one of these prefixes.
+NOTEMARKERS = (r"\f", r"\x", r"\+f", r"\+x", r"\ef", r"\ex", r"\cat")
+
 # -------------------------------------------------------------------------- #
 
 # osis 2.1.1 schema...
@@ -1373,6 +1621,79 @@ LOG.setLevel(logging.WARNING)
 
 # -------------------------------------------------------------------------- #
 
+# compiled osis schema. This is built the first time it's needed and then
+# reused for every conversion done by this process.
+OSISSCHEMA = None
+
+# hash of the source of this script. Cached books are keyed by it so that
+# books converted by an earlier version of the script are never used.
+SCRIPTHASH = None
+
+# calls and time spent in each stage of the conversion when profiling is
+# enabled. (see --profile)
+PROFILE = None
+
+# stages of the conversion that are timed when profiling is enabled, in
+# addition to the c2o_ functions.
+PROFILESTAGES = [
+    "decodeusfm",
+    "convertcl",
+    "reflow",
+    "getbookid",
+    "markintroend",
+    "convert_to_osis",
+    "parseosis",
+    "prettyosis",
+    "cleanosis",
+    "validatebook",
+    "validateosis",
+    "writeosis",
+    "writeverses",
+]
+
+# -------------------------------------------------------------------------- #
+
+
+def importmultiprocessing():
+    """
+    Import multiprocessing if we haven't already.
+
+    Returns True if it's available. (jython 2.7.0 doesn't have this module.)
+
+    """
+    # pylint: disable=global-statement,invalid-name,import-outside-toplevel
+    global HAVEMULTIPROCESSING, multiprocessing
+
+    if HAVEMULTIPROCESSING is None:
+        try:
+            import multiprocessing
+
+            HAVEMULTIPROCESSING = True
+        except ImportError:
+            HAVEMULTIPROCESSING = False
+    return HAVEMULTIPROCESSING
+
+
+def importlxml():
+    """
+    Import lxml if we haven't already.
+
+    Returns True if it's available. lxml is needed to validate our output
+    against the OSIS schema and to pretty print it.
+
+    """
+    # pylint: disable=global-statement,invalid-name,import-outside-toplevel
+    global HAVELXML, et
+
+    if HAVELXML is None:
+        try:
+            import lxml.etree as et
+
+            HAVELXML = True
+        except ImportError:
+            HAVELXML = False
+    return HAVELXML
+
 
 def convertcl(text):
     """
@@ -1398,9 +1719,12 @@ def convertcl(text):
         if lines[chaplines[0] - 1].startswith(r"\cl "):
             clmarker = lines[chaplines[0] - 1]
             lines[chaplines[0] - 1] = ""
-            for i in reversed(chaplines):
-                cnumber = lines[i].split(" ")[1]
-                lines.insert(i + 1, " ".join([clmarker, cnumber]))
+            newlines = []
+            for _ in lines:
+                newlines.append(_)
+                if _.startswith(r"\c "):
+                    newlines.append(" ".join([clmarker, _.split(" ")[1]]))
+            lines = newlines
 
     # return our lines with converted cl tags.
     return "\n".join(lines)
@@ -1423,16 +1747,7 @@ def reflow(text):
 
     def manglecheck(text):
         """Check to see if we have paragraph markup."""
-        retval = False
-        for _ in PARCHECK:
-            if re.search(
-                r"\\{}\b".format(_.lstrip(r"\\")),
-                text,
-                re.U + re.M + re.DOTALL,
-            ):
-                retval = True
-                break
-        return retval
+        return PARCHECKRE.search(text) is not None
 
     def endmark(text):
         """Mark end of cl, sp, and qa tags."""
@@ -1446,10 +1761,7 @@ def reflow(text):
 
     def reflowpar(text):
         """Put (almost) all paragraph tags on separate lines."""
-        for _ in PARFLOW:
-            if _ in text:
-                text = text.replace(r"{} ".format(_), "\n{} ".format(_))
-        return text
+        return PARFLOWRE.sub("\n\\g<0>", text)
 
     def fixlines(text):
         """Fix various potential issues with lines of text."""
@@ -1553,11 +1865,14 @@ def reflow(text):
 
         # make sure all lines start with a usfm tag...
         lines = text.split("\n")
+        newlines = []
         for _ in range(len(lines) - 1, 0, -1):
             if not lines[_].startswith("\\"):
                 lines[_ - 1] = "{} {}".format(lines[_ - 1], lines[1])
-                lines.pop(_)
-        text = "\n".join(lines)
+            else:
+                newlines.append(lines[_])
+        newlines.append(lines[0])
+        text = "\n".join(reversed(newlines))
         # remove some newlines that we don't want...
         for _ in [r"\ca", r"\cp", r"\va", r"\vp"]:
             text = text.replace("\n{}".format(_), " {}".format(_))
@@ -1609,15 +1924,17 @@ def markintroend(lines):
     to aid in adding div's to introduction sections.
 
     """
-    i = 0
-    j = len(lines)
+    newlines = []
     intro = False
-    while i < j:
-        tmp = lines[i].partition(" ")
-        if tmp[0:3] == r"\ie":
-            intro = False
-            lines.insert(i, "\ufde0")
-        elif tmp[0][:3] in [
+    # the end of the book isn't checked for one line for each introduction
+    # that's found. (this has always been the case. changing it would change
+    # the output for some books.)
+    checked = len(lines)
+    for num, line in enumerate(lines):
+        if num >= checked:
+            newlines.extend(lines[num:])
+            break
+        if line.partition(" ")[0][:3] in [
             r"\ib",
             r"\il",
             r"\im",
@@ -1628,19 +1945,18 @@ def markintroend(lines):
             r"\ie",
         ]:
             if not intro:
-                lines.insert(i, "\ufde0")
+                newlines.append("\ufde0")
                 intro = True
-        else:
-            if intro:
-                intro = False
-                lines.insert(i, "\ufde1")
-                j += 1
-        i += 1
+                checked -= 1
+        elif intro:
+            intro = False
+            newlines.append("\ufde1")
+        newlines.append(line)
 
     if intro:
-        lines.append("\ufde1")
+        newlines.append("\ufde1")
 
-    return lines
+    return newlines
 
 
 def parseattributes(tag, tagtext):
@@ -1674,6 +1990,11 @@ def parseattributes(tag, tagtext):
     return (text, attributestring, attribs, isinvalid)
 
 
+def lexmarkers(text):
+    """Get the set of markers present in usfm text."""
+    return set(USFMLEXRE.findall(text))
+
+
 # -------------------------------------------------------------------------- #
 # -------------------------------------------------------------------------- #
 
@@ -1733,11 +2054,13 @@ def c2o_identification(text, description):
 
 def c2o_titlepar(text, bookid):
     """Process title and paragraph tags."""
-    # local copies of global variables.
+    # the tag tables are never changed here, so they aren't copied.
+    # peripheral books use their own title tags.
     partags = PARTAGS
-    othertags = OTHERTAGS
     celltags = CELLTAGS
     titletags = TITLETAGS
+    if bookid in PERIPHBOOKS:
+        titletags = PERIPHTITLETAGS
 
     def titles_and_sections(line):
         """Process titles and sections."""
@@ -1853,23 +2176,6 @@ def c2o_titlepar(text, bookid):
                 )
         return " ".join(selahfix)
 
-    # add periph tag to titletags if book being processed
-    # is a  peripheral or private use book.
-    if bookid in [
-        "FRONT",
-        "INTRODUCTION",
-        "BACK",
-        "X-OTHER",
-        "XXA",
-        "XXB",
-        "XXC",
-        "XXD",
-        "XXE",
-        "XXF",
-        "XXG",
-    ]:
-        titletags[r"\periph"] = ('<title type="main">', "</title>")
-
     # ################################################################### #
     # NOTE: I've not seen any kind of documentation to suggest that usage
     #       of the usfm \d tag outside of psalms is valid.
@@ -1884,10 +2190,11 @@ def c2o_titlepar(text, bookid):
     #       judgment I've provided an implementation of this change as was
     #       requested.
     #
-    #       Uncomment the next 2 lines of code to enable handling of
+    #       Uncomment the next 3 lines of code to enable handling of
     #       incorrect use of this tag.
     #
     # if bookid != "Ps":
+    #     titletags = dict(titletags)
     #     titletags[r'\d'] = ('<title canonical="true">', '</title>')
     # ################################################################### #
 
@@ -1905,9 +2212,9 @@ def c2o_titlepar(text, bookid):
     elif line[0] == r"\tr":
         text = tables(line)
 
-    # other title, paragraph, intro tags
-    for _ in othertags.keys():
-        text = text.replace(_, othertags[_])
+    # other title, paragraph, intro tags. (only if there are tags left)
+    if "\\" in text:
+        text = OTHERTAGSRE.sub(lambda _: OTHERTAGS[_.group(0)], text)
 
     # fix selah
     if "<selah>" in text:
@@ -2031,23 +2338,25 @@ def c2o_specialtext(text):
 
     """
 
-    def simplerepl(match):
-        """Simple regex replacement helper function."""
-        tag = SPECIALTEXT[match.group("tag")]
-        return "{}{}{}".format(tag[0], match.group("osis"), tag[1])
-
-    text = SPECIALTEXTRE.sub(simplerepl, text, 0)
-    # Make sure all nested tags are processed.
-    # In order to avoid getting stuck here we abort
-    # after a maximum of 5 attempts. (5 was chosen arbitrarily)
-    nestcount = 0
-    while "\\" in text:
-        nestcount += 1
-        text = SPECIALTEXTRE.sub(simplerepl, text, 0)
-        if nestcount > 5:
-            break
+    # the text is split into alternating runs of text and markers. Start
+    # markers are kept on a stack until their end marker is found, and then
+    # both are replaced with the osis tags for that style. Markers that
+    # aren't matched are left as they are.
+    parts = SPECIALTEXTRE.split(text)
+    stack = []
+    for i in range(1, len(parts), 2):
+        if parts[i].endswith("*"):
+            tag = parts[i][:-1]
+            for j in range(len(stack) - 1, -1, -1):
+                if stack[j][0] == tag:
+                    parts[stack[j][1]] = SPECIALTEXT[tag][0]
+                    parts[i] = SPECIALTEXT[tag][1]
+                    del stack[j]
+                    break
+        else:
+            stack.append((parts[i].rstrip(), i))
 
-    return text
+    return "".join(parts)
 
 
 def c2o_noterefmarkers(text):
@@ -2058,54 +2367,20 @@ def c2o_noterefmarkers(text):
 
         def notefixsub(fnmatch):
             """Simple regex replacement helper function."""
-            tag = NOTETAGS2[fnmatch.groups()[0]]
+            if fnmatch.group("end") is not None:
+                return ""
+            tag = NOTETAGS2[fnmatch.group("tag")]
             if "<reference>" in tag:
-                txt, _, attrtxt = fnmatch.groups()[1].partition("|")
+                txt, _, attrtxt = fnmatch.group("osis").partition("|")
             else:
-                txt = fnmatch.groups()[1]
+                txt = fnmatch.group("osis")
                 attrtxt = None
             if attrtxt is not None:
                 txt = "<!-- USFM Attributes: {} -->{}".format(attrtxt, txt)
             return "".join([tag[0], txt, tag[1]])
 
-        notetext = NOTEFIXRE.sub(notefixsub, notetext, 0)
-        for _ in [
-            r"\fm*",
-            r"\fdc*",
-            r"\fr*",
-            r"\fk*",
-            r"\fq*",
-            r"\fqa*",
-            r"\fl*",
-            r"\fv*",
-            r"\ft*",
-            r"\xo*",
-            r"\xk*",
-            r"\xq*",
-            r"\xt*",
-            r"\xot*",
-            r"\xnt*",
-            r"\xdc*",
-            r"\+fm*",
-            r"\+fdc*",
-            r"\+fr*",
-            r"\+fk*",
-            r"\+fq*",
-            r"\+fqa*",
-            r"\+fl*",
-            r"\+fv*",
-            r"\+ft*",
-            r"\+xo*",
-            r"\+xk*",
-            r"\+xq*",
-            r"\+xt*",
-            r"\+xot*",
-            r"\+xnt*",
-            r"\+xdc*",
-        ]:
-            if _ in notetext:
-                notetext = notetext.replace(_, "")
-        return notetext
+        # tags and end markers are both handled in a single pass.
+        return NOTEFIXRE.sub(notefixsub, notetext, 0)
 
     def simplerepl(match):
         """Simple regex replacement helper function."""
@@ -2127,6 +2402,7 @@ def c2o_noterefmarkers(text):
     for _ in [r"\f", r"\x", r"\+f", r"\+x"]:
         if _ in text:
             text = notefix(text)
+            break
 
     # handle fp tags
     if r"\fp " in text:
@@ -2468,12 +2744,15 @@ def c2o_chapverse(lines, bookid):
         return retval
 
     # chapter and verse numbers
-    closerlist = [
-        _ for _ in range(len(lines)) if lines[_].startswith(r"<closer")
-    ]
-    for i in reversed(closerlist):
-        lines[i - 1] = " ".join([lines[i - 1], lines[i]])
-        del lines[i]
+    # closers are joined to the line before them. (the list is rebuilt
+    # once instead of deleting each closer from it.)
+    newlines = []
+    for line in lines:
+        if line.startswith(r"<closer") and newlines:
+            newlines[-1] = " ".join([newlines[-1], line])
+        else:
+            newlines.append(line)
+    lines = newlines
 
     chap = ""
     verse = ""
@@ -2623,18 +2902,6 @@ def c2o_processwj2(lines):
     in order to avoid crossing container boundaries.
 
     """
-    # get lists of tags where lines need to be broken for processing
-    wjstarttags = set()
-    wjendtags = set()
-    for _ in TITLETAGS:
-        if TITLETAGS[_][0] != "" and TITLETAGS[_][1] != "":
-            wjstarttags.add(TITLETAGS[_][0].strip())
-            wjendtags.add(TITLETAGS[_][1].strip())
-    for _ in PARTAGS:
-        if PARTAGS[_][0] != "" and PARTAGS[_][1] != "":
-            wjstarttags.add(PARTAGS[_][0].strip())
-            wjendtags.add(PARTAGS[_][1].strip())
-
     # prepare for processing by joining lines together
     text = "\ufdd1".join(lines)
 
@@ -2652,13 +2919,14 @@ def c2o_processwj2(lines):
             )
             lines[i[0]] = lines[i[0]].replace(r"\wj*", "</q>")
 
-            # add additional closing and opening q tags
-            for _ in wjstarttags:
-                lines[i[0]] = lines[i[0]].replace(
-                    _, '{}<q who="Jesus" marker="">'.format(_)
-                )
-            for _ in wjendtags:
-                lines[i[0]] = lines[i[0]].replace(_, "</q>{}".format(_))
+            # add additional closing and opening q tags.
+            lines[i[0]] = WJTAGSRE.sub(
+                lambda _: {
+                    True: "</q>{}".format(_.group(0)),
+                    False: '{}<q who="Jesus" marker="">'.format(_.group(0)),
+                }[_.group(0) in WJENDTAGS],
+                lines[i[0]],
+            )
 
     # rejoin lines, then resplit and return processed lines...
     text = "".join(lines)
@@ -2667,6 +2935,13 @@ def c2o_processwj2(lines):
 
 def c2o_postprocess(lines):
     """Attempt to fix some formatting issues."""
+
+    def verseends(lines):
+        """Get indexes of lines that start with verse end tags."""
+        return [
+            _ for _ in range(len(lines)) if lines[_].startswith("<verse eID")
+        ]
+
     # resplit lines for post processing,
     # removing leading and trailing whitespace, and b comments
     lines = [
@@ -2692,21 +2967,25 @@ def c2o_postprocess(lines):
             )
 
     # adjust some tags for postprocessing purposes.
-    i = len(lines)
-    while i > 0:
-        i -= 1
+    newlines = []
+    for line in lines:
         # remove empty l tags if present.
-        if lines[i] == '<l level="1"> </l>':
-            del lines[i]
+        if line == '<l level="1"> </l>':
             continue
         # move lb to it's own line
-        if lines[i].endswith('<lb type="x-p" />'):
-            lines.insert(i + 1, '<lb type="x-p" />')
-            lines[i] = lines[i].rpartition('<lb type="x-p" />')[0].strip()
+        lbline = line.endswith('<lb type="x-p" />')
+        if lbline:
+            line = line.rpartition('<lb type="x-p" />')[0].strip()
         # move lg to it's own line
-        if lines[i].endswith("<lg>"):
-            lines.insert(i + 1, "<lg>")
-            lines[i] = lines[i].rpartition("<lg>")[0].strip()
+        lgline = line.endswith("<lg>")
+        if lgline:
+            line = line.rpartition("<lg>")[0].strip()
+        newlines.append(line)
+        if lgline:
+            newlines.append("<lg>")
+        if lbline:
+            newlines.append('<lb type="x-p" />')
+    lines = newlines
 
     # swap lb and lg end tag when lg end tag follows lb.
     i = len(lines)
@@ -2719,110 +2998,96 @@ def c2o_postprocess(lines):
             pass
 
     # adjust placement of some verse end tags...
-    for i in [
-        _ for _ in range(len(lines)) if lines[_].startswith("<verse eID")
-    ]:
+    #
+    # Each of the rules below is checked against the positions of the
+    # verse end tags as they were before that rule was applied. Moving a
+    # verse end tag up past the line before it is a swap of two adjacent
+    # lines, which keeps the positions of all other lines intact. That
+    # means each rule is a single linear pass over the verse end tags.
+    for i in verseends(lines):
         if lines[i - 1].strip() in OSISL or lines[i - 1].strip() in OSISITEM:
-            lines.insert(i - 1, lines.pop(i))
-    for i in [
-        _ for _ in range(len(lines)) if lines[_].startswith("<verse eID")
-    ]:
+            lines[i - 1], lines[i] = lines[i], lines[i - 1]
+    for i in verseends(lines):
         if lines[i - 1] == "<row><cell>" and lines[i - 2] == "<table>":
-            lines.insert(i - 2, lines.pop(i))
-
-    for i, j in [
-        (x, y)
-        for x in [
-            "<p",
-            "<lb ",
-            "</p>",
-            "<lg",
-            "<lb ",
-            "</lg>",
-            "<list",
-            "<lb",
-            "</list>",
-            "<title",
-            "<title",
-            "<title",
-            "<title",
-            "<title",
-            "<div",
-            "</div>",
-        ]
-        for y in [
-            _ for _ in range(len(lines)) if lines[_].startswith("<verse eID")
-        ]
-    ]:
-        if lines[j - 1].startswith(i):
-            lines.insert(j - 1, lines.pop(j))
-        elif i == "<title":
-            if lines[j - 1].startswith("<!-- ") and i in lines[j - 1]:
-                lines.insert(j - 1, lines.pop(j))
-
-    for i, j in [
-        (x, y)
-        for x in [
-            "<lb ",
-            "</p>",
-            "</lg>",
-            "<lb",
-            "</list>",
-            "<lb",
-            "</p>",
-            "</div>",
-        ]
-        for y in [
-            _ for _ in range(len(lines)) if lines[_].startswith("<verse eID")
-        ]
-    ]:
-        if lines[j - 1].startswith(i):
-            lines.insert(j - 1, lines.pop(j))
+            lines[i - 2], lines[i - 1], lines[i] = (
+                lines[i],
+                lines[i - 2],
+                lines[i - 1],
+            )
 
-    for i, j in [
-        (x, y)
-        for x in ["</l>", "</item>"]
-        for y in [
-            _ for _ in range(len(lines)) if lines[_].startswith("<verse eID")
-        ]
+    verseidx = verseends(lines)
+    for i in [
+        "<p",
+        "<lb ",
+        "</p>",
+        "<lg",
+        "<lb ",
+        "</lg>",
+        "<list",
+        "<lb",
+        "</list>",
+        "<title",
+        "<title",
+        "<title",
+        "<title",
+        "<title",
+        "<div",
+        "</div>",
+    ]:
+        for j in verseidx:
+            if lines[j - 1].startswith(i):
+                lines[j - 1], lines[j] = lines[j], lines[j - 1]
+            elif i == "<title":
+                if lines[j - 1].startswith("<!-- ") and i in lines[j - 1]:
+                    lines[j - 1], lines[j] = lines[j], lines[j - 1]
+
+    verseidx = verseends(lines)
+    for i in [
+        "<lb ",
+        "</p>",
+        "</lg>",
+        "<lb",
+        "</list>",
+        "<lb",
+        "</p>",
+        "</div>",
     ]:
-        if lines[j - 1].endswith(i):
-            tmp = lines[j - 1].rpartition("<")
-            lines[j - 1] = "{}{}{}{}".format(tmp[0], lines[j], tmp[1], tmp[2])
-            lines[j] = ""
+        for j in verseidx:
+            if lines[j - 1].startswith(i):
+                lines[j - 1], lines[j] = lines[j], lines[j - 1]
+
+    verseidx = verseends(lines)
+    for i in ["</l>", "</item>"]:
+        for j in verseidx:
+            if lines[j - 1].endswith(i):
+                tmp = lines[j - 1].rpartition("<")
+                lines[j - 1] = "{}{}{}{}".format(
+                    tmp[0], lines[j], tmp[1], tmp[2]
+                )
+                lines[j] = ""
 
     lines = [_ for _ in lines if _ != ""]
 
     # special fix for verse end markers following "acrostic" titles...
     # because I can't figure out why my other fixes aren't working.
-    for i, j in [
-        (x, y)
-        for x in ['<title type="acrostic"', "</lg"]
-        for y in [
-            _ for _ in range(len(lines)) if lines[_].startswith("<verse eID")
-        ]
-    ]:
-        if lines[j - 1].startswith(i):
-            lines.insert(j - 1, lines.pop(j))
+    verseidx = verseends(lines)
+    for i in ['<title type="acrostic"', "</lg"]:
+        for j in verseidx:
+            if lines[j - 1].startswith(i):
+                lines[j - 1], lines[j] = lines[j], lines[j - 1]
 
-    for i in [
-        _ for _ in range(len(lines)) if lines[_].startswith("<verse eID")
-    ]:
+    for i in verseends(lines):
         if lines[i - 1].endswith("</l>"):
             lines[i - 1] = "{}{}</l>".format(
                 lines[i - 1].rpartition("<")[0], lines[i]
             )
             lines[i] = ""
 
-    for i, j in [
-        (x, y)
-        for x in ["<!-- ", "</p>"]
-        for y in [
-            _ for _ in range(len(lines)) if lines[_].startswith("<verse eID")
-        ]
-    ]:
-        if lines[j - 1].startswith(i):
-            lines.insert(j - 1, lines.pop(j))
+    verseidx = verseends(lines)
+    for i in ["<!-- ", "</p>"]:
+        for j in verseidx:
+            if lines[j - 1].startswith(i):
+                lines[j - 1], lines[j] = lines[j], lines[j - 1]
 
     # adjust placement of verse tags in relation
     # to d titles that contain verses.
@@ -2843,22 +3108,20 @@ def c2o_postprocess(lines):
     # -- # -- # -- #
 
     # adjust placement of some chapter end tags
-    for i, j in [
-        (x, y)
-        for x in range(3)
-        for y in [
-            _ for _ in range(len(lines)) if lines[_].startswith("<chapter eID")
-        ]
-    ]:
-        try:
-            if "<title" in lines[j - 1]:
-                lines.insert(j - 1, lines.pop(j))
-            elif "chapterLabel" in lines[j - 1]:
-                lines.insert(j - 1, lines.pop(j))
-            elif lines[j - 1] == "</p>":
-                lines.insert(j - 1, lines.pop(j))
-        except IndexError:
-            pass
+    chapteridx = [
+        _ for _ in range(len(lines)) if lines[_].startswith("<chapter eID")
+    ]
+    for i in range(3):
+        for j in chapteridx:
+            try:
+                if (
+                    "<title" in lines[j - 1]
+                    or "chapterLabel" in lines[j - 1]
+                    or lines[j - 1] == "</p>"
+                ):
+                    lines[j - 1], lines[j] = lines[j], lines[j - 1]
+            except IndexError:
+                pass
 
     # adjust placement of some chapter start tags
     for i in [
@@ -2866,13 +3129,13 @@ def c2o_postprocess(lines):
     ]:
         try:
             if lines[i + 1] == "</p>" and lines[i + 2].startswith("<p"):
-                lines.insert(i + 2, lines.pop(i))
+                lines[i : i + 3] = [lines[i + 1], lines[i + 2], lines[i]]
             elif (
                 lines[i + 1] == "</p>"
                 and "chapterLabel" in lines[i + 2]
                 and lines[i + 3].startswith("<p")
             ):
-                lines.insert(i + 3, lines.pop(i))
+                lines[i : i + 4] = lines[i + 1 : i + 4] + [lines[i]]
         except IndexError:
             pass
     for i in [
@@ -2884,7 +3147,7 @@ def c2o_postprocess(lines):
                 and lines[i + 2] == "</div>"
                 and lines[i + 3].startswith("<div")
             ):
-                lines.insert(i + 3, lines.pop(i))
+                lines[i : i + 4] = lines[i + 1 : i + 4] + [lines[i]]
         except IndexError:
             pass
 
@@ -2946,22 +3209,22 @@ def c2o_postprocess(lines):
     return lines
 
 
-def convert_to_osis(text, bookid="TEST"):
-    """Convert usfm file to osis."""
-    # ---------------------------------------------------------------------- #
-
-    description = []
-
-    # ---------------------------------------------------------------------- #
+def convertshard(args):
+    """
+    Process the lines of a book, or a shard of its chapters, one by one.
 
-    # split text into lines for processing
-    lines = text.split("\n")
+    args is a tuple of the lines, the book id, and whether to profile the
+    shard in a new profile. Each line is converted on its own, so a book
+    can be split into shards anywhere and converted in parallel. Returns
+    the converted lines, the description lines that were found, and the
+    profile for the shard, which is None unless it was asked for. (used by
+    the worker processes)
 
-    # mark introduction endings...
-    for _ in [r"\ib", r"\ie", r"\il", r"\im", r"\io", r"\ip", r"\iq", r"\is"]:
-        if _ in text:
-            lines = markintroend(lines)
-            break
+    """
+    lines, bookid, profile = args
+    if profile:
+        enableprofiling()
+    description = []
 
     for i in enumerate(lines):
 
@@ -2971,12 +3234,26 @@ def convert_to_osis(text, bookid="TEST"):
                 lines[i[0]] = c2o_preprocess(lines[i[0]])
                 break
 
+        # find the markers in the line once. They determine which of the
+        # processing stages below need to be run. Lines without any markers
+        # don't need any further processing.
+        markers = lexmarkers(lines[i[0]])
+        if not markers:
+            continue
+
         # identification
-        lines[i[0]], description = c2o_identification(lines[i[0]], description)
+        if lines[i[0]].startswith("\\"):
+            lines[i[0]], description = c2o_identification(
+                lines[i[0]], description
+            )
 
         # character style formatting
-        lines[i[0]] = c2o_noterefmarkers(lines[i[0]])
-        lines[i[0]] = c2o_specialtext(lines[i[0]])
+        for _ in markers:
+            if _.startswith(NOTEMARKERS):
+                lines[i[0]] = c2o_noterefmarkers(lines[i[0]])
+                break
+        if not markers.isdisjoint(SPECIALTEXTMARKERS):
+            lines[i[0]] = c2o_specialtext(lines[i[0]])
 
         # special features if present, and stray \xt tags that were missed.
         for _ in [r"\ndx", r"\pro", r"\w", r"\+w", r"\fig", r"\xt", r"\+xt"]:
@@ -2995,6 +3272,60 @@ def convert_to_osis(text, bookid="TEST"):
         # paragraph style formatting.
         lines[i[0]] = c2o_titlepar(lines[i[0]], bookid)
 
+    return lines, description, {True: PROFILE, False: None}[profile]
+
+
+def splitchapters(lines, chapters):
+    """Split the lines of a book into shards of a number of chapters."""
+    shards = [[]]
+    count = 0
+    for line in lines:
+        if line.startswith("\\c "):
+            count += 1
+            if count > chapters:
+                shards.append([])
+                count = 1
+        shards[-1].append(line)
+    return shards
+
+
+def convert_to_osis(text, bookid="TEST", pool=None, shard=None, profile=False):
+    """
+    Convert usfm file to osis.
+
+    If a multiprocessing pool is given, and a number of chapters per shard,
+    the lines of the book are converted by the pool in shards of that many
+    chapters. The stages that work across chapters are run here after the
+    shards are put back together. If profile is true the shards are
+    profiled and their profiles are added to the profile for this process.
+
+    """
+    # split text into lines for processing
+    lines = text.split("\n")
+
+    # mark introduction endings...
+    for _ in [r"\ib", r"\ie", r"\il", r"\im", r"\io", r"\ip", r"\iq", r"\is"]:
+        if _ in text:
+            lines = markintroend(lines)
+            break
+
+    if pool is not None and shard is not None:
+        description = []
+        shards = splitchapters(lines, shard)
+        lines = []
+        for shardlines, sharddescription, shardprofile in pool.map(
+            convertshard, [(_, bookid, profile) for _ in shards], 1
+        ):
+            lines.extend(shardlines)
+            description.extend(sharddescription)
+            if shardprofile is not None:
+                for name, (calls, seconds) in shardprofile.items():
+                    stage = PROFILE.setdefault(name, [0, 0.0])
+                    stage[0] += calls
+                    stage[1] += seconds
+    else:
+        lines, description, _ = convertshard((lines, bookid, False))
+
     # process words of Jesus
     if r"\wj" in text:
         lines = c2o_processwj2(lines)
@@ -3019,123 +3350,842 @@ def convert_to_osis(text, bookid="TEST"):
 # -------------------------------------------------------------------------- #
 
 
-def doconvert(args):
-    """Convert our text and return our results."""
-    text = args
+def parseosis(text, wrap=True):
+    """
+    Parse part of an osis doc so that it can be pretty printed.
 
-    # convert cl lines to form that follows each chapter marker instead of
-    # form that precedes first chapter.
-    if r"\cl " in text:
-        text = convertcl(text)
+    Books are wrapped in osis and osisText elements so that they're
+    indented the same way they would be in the complete document.
 
-    # decode and reflow our text
-    newtext = reflow(text)
+    """
+    if wrap:
+        text = "{}{}{}".format(OSISWRAPPER[0], text, OSISWRAPPER[1])
+    return et.fromstring(
+        SQUEEZE.sub(" ", text).encode("utf-8"),
+        et.XMLParser(remove_blank_text=True),
+    )
 
-    # get book id. use TEST if none present.
-    bookid = getbookid(newtext)
-    if bookid is not None:
-        if bookid.startswith("* "):
-            LOG.error("Book id naming issue - %s", bookid.replace("* ", ""))
-    else:
-        bookid = "TEST"
 
-    # convert file to osis
-    LOG.info("... Processing %s ...", bookid)
-    newtext, descriptiontext = convert_to_osis(newtext, bookid)
-    return (bookid, descriptiontext, newtext)
+def prettyosis(text, wrap=True):
+    """
+    Pretty print part of an osis doc and return it as a list of lines.
 
+    text can also be an element that was returned by parseosis. The lines
+    from the wrapper are not returned.
 
-def processfiles(args):
-    """Process usfm files specified on command line."""
-    books = {}
-    descriptions = {}
-    booklist = []
+    """
+    if not et.iselement(text):
+        text = parseosis(text, wrap)
+    text = et.tostring(
+        text,
+        pretty_print=True,
+        xml_declaration=True,
+        encoding="utf-8",
+    )
+    text = text.decode("utf-8").splitlines(True)
+    return {True: text[3:-2], False: text}[wrap]
 
-    files = []
 
-    # get username from operating system
-    username = {True: os.getenv("LOGNAME"), False: os.getenv("USERNAME")}[
-        os.getenv("USERNAME") is None
-    ]
+def cleanosis(text):
+    """Simple whitespace cleanups for osis text before writing to file."""
+    for i in (
+        (" <note", "<note"),
+        (" </p>", "</p>"),
+        (" </item>", "</item>"),
+        (" </l>", "</l>"),
+        ("</w><w", "</w> <w"),
+    ):
+        text = text.replace(i[0], i[1])
+    return text
 
-    # read all files
-    LOG.info("Reading files... ")
-    for fname in args.file:
-        # read our text files
-        with open(fname, "rb") as ifile:
-            text = ifile.read()
 
-        # strip whitespace from beginning and end of file
-        text = text.strip()
+def validatebook(text, cachedir=None, book=None):
+    """
+    Validate a single book against the OSIS schema.
+
+    The book is wrapped in a minimal osis document. Whitespace is squeezed
+    within each line but line breaks are kept so that errors can be
+    reported by line number within the book. Returns a list of
+    (line, message) tuples, which is empty if the book is valid.
+
+    If the book was already parsed by parseosis it's validated without
+    parsing it again, and is only parsed again to find the line numbers of
+    any errors. The parsed book is moved into the document while doing so.
+
+    """
+    if book is not None:
+        envelope = et.fromstring(
+            "{}{}".format(OSISENVELOPE[0], OSISENVELOPE[1]).encode("utf-8")
+        )
+        envelope[0].extend(book[0])
+        if getschema(cachedir).validate(envelope):
+            return []
+
+    text = "\n".join([SQUEEZE.sub(" ", _) for _ in text.split("\n")])
+    vparser = et.XMLParser(remove_blank_text=True)
+    try:
+        book = et.fromstring(
+            "{}{}{}".format(OSISENVELOPE[0], text, OSISENVELOPE[1]).encode(
+                "utf-8"
+            ),
+            vparser,
+        )
+    except et.XMLSyntaxError:
+        return [(_.line, _.message) for _ in vparser.error_log]
+    schema = getschema(cachedir)
+    if schema.validate(book):
+        return []
+    return [(_.line, _.message) for _ in schema.error_log]
+
+
+def doconvert(args, pool=None):
+    """
+    Convert our text and return our results.
+
+    args is a tuple of the text to convert and our command line options.
+    The book is returned ready for output, along with a pretty printed
+    copy and a list of validation errors. The pretty printed book is None
+    if it's not needed or the book is not well formed xml. Books are not
+    validated here if strict validation of the complete doc was requested,
+    unless per book validation was also requested. If a multiprocessing
+    pool is given the chapters of the book are converted by the pool in
+    shards. (see --shard)
+
+    """
+    text, options = args
+
+    # convert cl lines to form that follows each chapter marker instead of
+    # form that precedes first chapter.
+    if r"\cl " in text:
+        text = convertcl(text)
+
+    # decode and reflow our text
+    newtext = reflow(text)
 
-        # get encoding. Abort processing if we don't know the encoding.
-        # default to utf-8-sig encoding if no encoding is specified.
+    # get book id. use TEST if none present.
+    bookid = getbookid(newtext)
+    if bookid is not None:
+        if bookid.startswith("* "):
+            LOG.error("Book id naming issue - %s", bookid.replace("* ", ""))
+    else:
+        bookid = "TEST"
+
+    # convert file to osis
+    LOG.info("... Processing %s ...", bookid)
+    newtext, descriptiontext = convert_to_osis(
+        newtext, bookid, pool, options.shard, options.profile is not None
+    )
+    if bookid != "TEST":
+        if bookid in NONCANONICAL:
+            newtext = '<div type="{}">\n{}\n</div>\n\n'.format(
+                NONCANONICAL[bookid], newtext
+            )
+        else:
+            newtext = (
+                '<div type="book" osisID="{}" {}>\n{}\n</div>\n\n'.format(
+                    bookid, 'canonical="true"', newtext
+                )
+            )
+
+    # apply NFC normalization to text unless explicitly disabled.
+    if not options.n:
+        newtext = unicodedata.normalize("NFC", newtext)
+
+    # books are pretty printed here unless we know that won't be needed.
+    # the parsed book is kept so that it isn't parsed again for validation.
+    book = None
+    prettytext = None
+    if not (options.x and (options.d or options.verses_only)) and importlxml():
         try:
-            if args.e is not None:
-                bookencoding = codecs.lookup(args.e).name
-            else:
-                bookencoding = getencoding(text)
-                if bookencoding is not None:
-                    if bookencoding == "65001 - Unicode (UTF-8)":
-                        bookencoding = "utf-8-sig"
-                    else:
-                        bookencoding = codecs.lookup(bookencoding).name
-                else:
+            book = parseosis(newtext)
+            prettytext = cleanosis("".join(prettyosis(book)))
+        except et.XMLSyntaxError:
+            pass
+
+    # books are validated here unless the complete doc is validated at once.
+    errors = []
+    if not options.x and (options.b or not options.strict):
+        errors = validatebook(newtext, options.cache, book)
+
+    # only the copy of the book that will be written is sent back, unless
+    # the verse table needs the plain copy too. books without an id are
+    # never pretty printed in the osis doc. (see buildosis)
+    if bookid == "TEST":
+        prettytext = None
+    plaintext = None
+    if prettytext is None or options.verses is not None:
+        plaintext = cleanosis(newtext)
+    return (bookid, descriptiontext, plaintext, prettytext, errors)
+
+
+def plainoptions(args):
+    """Get our options for converting books without pretty printing them."""
+    options = argparse.Namespace(**vars(args))
+    options.x = True
+    options.d = True
+    options.profile = None
+    return options
+
+
+class UnknownEncodingError(LookupError):
+    """
+    The encoding of a usfm file is unknown.
+
+    The arguments are the name of the file and the encoding it gave.
+
+    """
+
+
+def decodeusfm(text, fname, encoding=None):
+    """
+    Decode the contents of a usfm file.
+
+    Raises UnknownEncodingError if the encoding is unknown.
+
+    """
+    # strip whitespace from beginning and end of file
+    text = text.strip()
+
+    # get encoding. default to utf-8-sig encoding if no encoding is
+    # specified.
+    bookencoding = encoding
+    try:
+        if encoding is not None:
+            bookencoding = codecs.lookup(encoding).name
+        else:
+            bookencoding = getencoding(text)
+            if bookencoding is not None:
+                if bookencoding == "65001 - Unicode (UTF-8)":
                     bookencoding = "utf-8-sig"
-            # use utf-8-sig in place of utf-8 encoding to eliminate errors that
-            # may occur if a Byte Order Mark is present in the input file.
-            if bookencoding == "utf-8":
+                else:
+                    bookencoding = codecs.lookup(bookencoding).name
+            else:
                 bookencoding = "utf-8-sig"
-        except LookupError:
-            LOG.error("ERROR: Unknown encoding... aborting conversion.")
-            LOG.error(r"    \ide line for %s says --> %s", fname, bookencoding)
+        # use utf-8-sig in place of utf-8 encoding to eliminate errors that
+        # may occur if a Byte Order Mark is present in the input file.
+        if bookencoding == "utf-8":
+            bookencoding = "utf-8-sig"
+    except LookupError:
+        raise UnknownEncodingError(fname, bookencoding)
+
+    # convert file to unicode
+    return text.decode(bookencoding)
+
+
+def getscripthash():
+    """Get the hash of the source of this script."""
+    global SCRIPTHASH  # pylint: disable=global-statement
+
+    if SCRIPTHASH is None:
+        with open(os.path.abspath(__file__), "rb") as ifile:
+            SCRIPTHASH = hashlib.sha256(ifile.read()).hexdigest()
+    return SCRIPTHASH
+
+
+def gettmpfile(fname):
+    """
+    Get the name of a temporary file to write before it's renamed to fname.
+
+    The name is unique to this thread, since the threads of the server can
+    write the same file at the same time.
+
+    """
+    return "{}.{}.{}".format(
+        fname, os.getpid(), threading.current_thread().ident
+    )
+
+
+def bookcachefile(text, options):
+    """Get the name of the cache file for the contents of a usfm file."""
+    key = hashlib.sha256(text)
+    key.update(
+        json.dumps(
+            [
+                META["VERSION"],
+                getscripthash(),
+                options.e,
+                options.n,
+                options.x,
+                options.d,
+                options.b,
+                options.strict,
+                options.verses_only,
+                options.verses is not None,
+                importlxml(),
+            ]
+        ).encode("utf-8")
+    )
+    return os.path.join(
+        options.cache, "books", "{}.json".format(key.hexdigest())
+    )
+
+
+def convertfile(args):
+    """
+    Read and convert a usfm file. (used by the worker processes)
+
+    args is a tuple of the position of the file on the command line, the
+    file name, and our command line options. See converttext for what's
+    returned.
+
+    """
+    num, fname, options = args
+    with open(fname, "rb") as ifile:
+        text = ifile.read()
+    return converttext((num, text, fname, options))
+
+
+def convertchanged(args):
+    """
+    Read and convert a usfm file that changed. (used by watch mode)
+
+    This is the same as convertfile, except that an error is returned in
+    place of the results from doconvert so that it doesn't stop the other
+    books from being converted.
+
+    """
+    try:
+        return convertfile(args)
+    except Exception as err:  # pylint: disable=broad-except
+        return (args[0], None, err, None)
+
+
+def converttext(args, pool=None):
+    """
+    Convert the contents of a usfm file. (used by the worker processes)
+
+    args is a tuple of the position of the book, the text of the book as
+    bytes or an already decoded string, the name of the book for error
+    messages, and our command line options. Returns a tuple of the
+    position of the book, cache statistics, the results from doconvert,
+    and profiling data. Cache statistics are None if there's no cache,
+    otherwise they're a tuple of "hit" or "miss" and the number of bytes
+    read from or written to the cache. Profiling data is None unless
+    profiling was requested. pool is passed on to doconvert.
+
+    """
+    num, text, fname, options = args
+    if options.profile is not None:
+        enableprofiling()
+
+    # use cached results if we have them.
+    results = None
+    cachestats = None
+    if options.cache is not None:
+        # decoded text is cached by its utf-8 encoding.
+        key = text
+        if not isinstance(key, bytes):
+            key = key.encode("utf-8")
+        cachefile = bookcachefile(key, options)
+        try:
+            with open(cachefile, "rb") as ifile:
+                cached = ifile.read()
+            results = tuple(json.loads(cached.decode("utf-8")))
+            cachestats = ("hit", len(cached))
+            # mark cached book as recently used. (see prunecache)
+            stamp = time.time()
+            os.utime(cachefile, (stamp, stamp))
+        except (IOError, OSError, ValueError):
+            pass
+
+    if results is None:
+        if isinstance(text, bytes):
+            text = decodeusfm(text, fname, options.e)
+        else:
+            # strip strings the same way as usfm files.
+            text = text.lstrip("\ufeff").strip()
+        results = doconvert((text, options), pool)
+        if options.cache is not None:
+            cached = json.dumps(results).encode("utf-8")
+            cachestats = ("miss", len(cached))
+            try:
+                # write to a temporary file first so that other processes
+                # never see a partially written cache file.
+                tmpfile = gettmpfile(cachefile)
+                with open(tmpfile, "wb") as ofile:
+                    ofile.write(cached)
+                if os.path.exists(cachefile):
+                    os.remove(cachefile)
+                os.rename(tmpfile, cachefile)
+                stamp = time.time()
+                os.utime(cachefile, (stamp, stamp))
+            except (IOError, OSError) as err:
+                LOG.warning("Unable to cache %s: %s", fname, str(err))
+
+    return (num, cachestats, results, PROFILE)
+
+
+def prunecache(cachedir, days, now=None):
+    """
+    Remove cached books that haven't been used for a number of days.
+
+    The number of days is counted back from now, which defaults to the
+    current time. Passing the time a conversion started keeps the books
+    used by that conversion even when days is 0. Books are stamped with
+    time.time() when they're used since the clock the file system uses
+    for modification times can be a few milliseconds behind it.
+
+    """
+    if now is None:
+        now = time.time()
+    cutoff = now - days * 86400
+    removed = 0
+    removedbytes = 0
+    bookdir = os.path.join(cachedir, "books")
+    if os.path.isdir(bookdir):
+        for fname in os.listdir(bookdir):
+            fname = os.path.join(bookdir, fname)
+            try:
+                stat = os.stat(fname)
+                if stat.st_mtime < cutoff:
+                    os.remove(fname)
+                    removed += 1
+                    removedbytes += stat.st_size
+            except OSError:
+                pass
+    LOG.info(
+        "Pruned %s cached books (%s bytes) from %s",
+        removed,
+        removedbytes,
+        cachedir,
+    )
+
+
+def profilestage(name, func):
+    """Wrap a stage of the conversion so that calls to it are timed."""
+
+    def timedstage(*args, **kwargs):
+        """Call our stage and record the time it took."""
+        starttime = timeit.default_timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stage = PROFILE.setdefault(name, [0, 0.0])
+            stage[0] += 1
+            stage[1] += timeit.default_timer() - starttime
+
+    return timedstage
+
+
+def enableprofiling():
+    """
+    Start a new profile for this process.
+
+    The conversion stages are wrapped the first time this is called so
+    that there is no overhead at all when profiling is not used.
+
+    """
+    global PROFILE  # pylint: disable=global-statement
+
+    if PROFILE is None:
+        for name in PROFILESTAGES + sorted(
+            [_ for _ in globals() if _.startswith("c2o_")]
+        ):
+            globals()[name] = profilestage(name, globals()[name])
+    PROFILE = {}
+
+
+def writeprofile(fname, books, document):
+    """
+    Write a profiling report as json and print a summary table.
+
+    books maps book ids to the profile for each book. document is the
+    profile for the stages that run once for the whole osis doc.
+
+    """
+    total = {}
+    for profile in list(books.values()) + [document]:
+        for name, (calls, seconds) in profile.items():
+            stage = total.setdefault(name, [0, 0.0])
+            stage[0] += calls
+            stage[1] += seconds
+
+    def report(profile):
+        """Convert a profile to a form that's easier to read in json."""
+        return OrderedDict(
+            [
+                (_[0], OrderedDict([("calls", _[1][0]), ("seconds", _[1][1])]))
+                for _ in sorted(profile.items(), key=lambda _: -_[1][1])
+            ]
+        )
+
+    with codecs.open(fname, "w", "utf-8") as ofile:
+        json.dump(
+            OrderedDict(
+                [
+                    ("total", report(total)),
+                    ("document", report(document)),
+                    (
+                        "books",
+                        OrderedDict(
+                            [(_, report(books[_])) for _ in books.keys()]
+                        ),
+                    ),
+                ]
+            ),
+            ofile,
+            indent=2,
+        )
+
+    summary = "{:<24} {:>10} {:>10} {:>12}"
+    print(summary.format("stage", "calls", "seconds", "ms per call"))
+    for name, stage in report(total).items():
+        print(
+            summary.format(
+                name,
+                stage["calls"],
+                "{:.3f}".format(stage["seconds"]),
+                "{:.4f}".format(stage["seconds"] * 1000 / stage["calls"]),
+            )
+        )
+
+
+def getschema(cachedir=None):
+    """
+    Get the compiled OSIS schema.
+
+    The schema is decompressed and compiled only once per process. If a
+    cache directory is given the decompressed schema is stored there, keyed
+    by the version of this script, so that later runs can skip decoding it.
+
+    """
+    global OSISSCHEMA  # pylint: disable=global-statement
+
+    if OSISSCHEMA is None:
+        osisschema = None
+        cachefile = None
+        if cachedir is not None:
+            cachefile = os.path.join(
+                cachedir,
+                "osisCore.{}-u2o-{}.xsd".format(META["OSIS"], META["VERSION"]),
+            )
+            try:
+                with codecs.open(cachefile, "r", "utf-8") as ifile:
+                    osisschema = ifile.read()
+            except (IOError, OSError):
+                pass
+        if osisschema is None:
+            osisschema = codecs.decode(
+                codecs.decode(codecs.decode(SCHEMA, "base64"), "bz2"), "utf-8"
+            )
+            if cachefile is not None:
+                try:
+                    if not os.path.isdir(cachedir):
+                        os.makedirs(cachedir)
+                    # write to a temporary file first so that other
+                    # processes never see a partially written schema.
+                    tmpfile = gettmpfile(cachefile)
+                    with codecs.open(tmpfile, "w", "utf-8") as ofile:
+                        ofile.write(osisschema)
+                    os.rename(tmpfile, cachefile)
+                except (IOError, OSError) as err:
+                    LOG.warning("Unable to cache OSIS schema: %s", str(err))
+        OSISSCHEMA = et.XMLSchema(et.XML(osisschema))
+
+    return OSISSCHEMA
+
+
+def validateosis(parts, schema=None):
+    """
+    Validate an osis doc that's given one part at a time.
+
+    Raises XMLSyntaxError if validation fails. If no schema is given the
+    doc is only checked to make sure it's well formed. Books are discarded
+    once they have been validated so the entire document is never held in
+    memory at the same time.
+
+    """
+    vparser = et.XMLPullParser(
+        events=("end",), tag="{*}div", schema=schema, remove_blank_text=True
+    )
+    for part in parts:
+        # squeezing whitespace doesn't matter if we're only making sure
+        # that the doc is well formed.
+        if schema is not None:
+            part = SQUEEZE.sub(" ", part)
+        vparser.feed(part.encode("utf-8"))
+        for _, element in vparser.read_events():
+            if element.getparent().tag.endswith("}osisText"):
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+    vparser.close()
+
+
+def bookverses(text):
+    """
+    Get the verses of a converted book.
+
+    Yields a tuple of the osis book id, chapter, verse, plain text, and
+    osis markup of each verse. Verses are kept as strings since they can be
+    ranges or parts of verses, such as 8-9 or 1!a. Notes, comments, and
+    headings are left out of the plain text.
+
+    """
+    for match in VERSERE.finditer(text):
+        book, chapter, verse = match.group("id").split(".", 2)
+        if chapter.isdigit():
+            chapter = int(chapter)
+        markup = SQUEEZE.sub(" ", match.group("markup")).strip()
+        plaintext = OSISTAGRE.sub("", VERSENOTESRE.sub("", markup))
+        for i in (("&lt;", "<"), ("&gt;", ">"), ("&amp;", "&")):
+            plaintext = plaintext.replace(i[0], i[1])
+        yield (
+            book,
+            chapter,
+            verse,
+            SQUEEZE.sub(" ", plaintext).strip(),
+            markup,
+        )
+
+
+def writeverses(outfile, results, args):
+    """
+    Write a table of the verses in the converted books.
+
+    The table is read straight from the converted books, so it doesn't
+    need the osis doc. The format depends on the file extension. (see
+    VERSEFORMATS) SQLite tables are written in a single transaction, and
+    replace the verses of the same work from an earlier run so that
+    several works can be kept in one database.
+
+    """
+    books = OrderedDict()
+    for _, _, result, _ in results:
+        books.setdefault(result[0], []).append(result[2])
+    columns = ["work", "book", "chapter", "verse", "text", "markup"]
+    if not args.verse_markup:
+        columns = columns[:-1]
+
+    def rows():
+        """Get the rows of the table in the order given with -s."""
+        for bookid in getbookorder(list(books.keys()), args.s):
+            for text in books[bookid]:
+                for verse in bookverses(text):
+                    yield (args.workid,) + verse[: len(columns) - 1]
+
+    verseformat = VERSEFORMATS[os.path.splitext(outfile)[1].lower()]
+    if verseformat == "jsonl":
+        with codecs.open(outfile, "w", "utf-8") as ofile:
+            for row in rows():
+                ofile.write(
+                    "{}\n".format(
+                        json.dumps(
+                            OrderedDict(zip(columns, row)), ensure_ascii=False
+                        )
+                    )
+                )
+    elif verseformat == "tsv":
+        # squeezing whitespace leaves no tabs or line breaks in the text.
+        with codecs.open(outfile, "w", "utf-8") as ofile:
+            ofile.write("{}\n".format("\t".join(columns)))
+            for row in rows():
+                ofile.write(
+                    "{}\n".format("\t".join(["{}".format(_) for _ in row]))
+                )
+    else:
+        # pylint: disable=import-outside-toplevel
+        try:
+            import sqlite3
+        except ImportError:
+            LOG.error("sqlite3 is needed to write SQLite verse tables.")
             sys.exit()
-        # convert file to unicode and add contents to list for processing...
-        files.append(text.decode(bookencoding))
+        connection = sqlite3.connect(outfile)
+        try:
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS verses (work TEXT, book TEXT, "
+                    "chapter INTEGER, verse TEXT, text TEXT, markup TEXT)"
+                )
+                connection.execute(
+                    "DELETE FROM verses WHERE work = ?", (args.workid,)
+                )
+                connection.executemany(
+                    "INSERT INTO verses ({}) VALUES ({})".format(
+                        ", ".join(columns), ", ".join(["?"] * len(columns))
+                    ),
+                    rows(),
+                )
+        finally:
+            connection.close()
+
+
+def writeosis(outfile, parts):
+    """
+    Write an osis doc to a file one part at a time.
 
-    # set number of processes to use while processing file contents
+    A temporary file is used so that a failed conversion never leaves a
+    partial osis file behind. Returns the set of unhandled usfm tags that
+    were found in the doc.
+
+    """
+    tmpfile = "{}.{}".format(outfile, os.getpid())
+    usfmtagset = set()
+    try:
+        with open(tmpfile, "wb") as ofile:
+            for part in parts:
+                # find unhandled usfm tags that are leftover after processing
+                usfmtagset.update(USFMRE.findall(part))
+                ofile.write(part.encode("utf-8"))
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        os.rename(tmpfile, outfile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+    return usfmtagset
+
+
+def getnumprocesses(args):
+    """Get number of processes to use while processing file contents."""
     numprocesses = 1
-    if not args.d and HAVEMULTIPROCESSING:
-        try:
-            numprocesses = multiprocessing.cpu_count()
-        except NotImplementedError:
-            numprocesses = 1
+    if not args.d and importmultiprocessing():
+        if args.j is not None:
+            numprocesses = max(args.j, 1)
+        else:
+            try:
+                numprocesses = multiprocessing.cpu_count()
+            except NotImplementedError:
+                numprocesses = 1
+    return numprocesses
+
+
+def runworkers(func, jobs, numprocesses, pool=None):
+    """
+    Call func for each job and return the results in the order given.
 
-    # process file contents
-    filelist = files
+    Each job is a tuple that starts with its position, and so does each
+    result. If a multiprocessing pool is given it's used instead of
+    creating a new one.
+
+    """
     results = []
-    LOG.info("Processing files...")
-    if numprocesses == 1:
-        results = [doconvert(_) for _ in filelist]
+    if pool is not None:
+        # use the worker pool we were given.
+        results = pool.imap_unordered(func, jobs)
+    elif numprocesses == 1:
+        results = (func(_) for _ in jobs)
     else:
         try:
             with multiprocessing.Pool(numprocesses) as pool:
-                results = pool.imap(doconvert, filelist)
+                results = pool.imap_unordered(func, jobs)
                 pool.close()
                 pool.join()
         except AttributeError:
             # pylint: disable=no-member
             with closing(multiprocessing.Pool(numprocesses)) as pool:
-                results = pool.imap(doconvert, filelist)
+                results = pool.imap_unordered(func, jobs)
                 pool.close()
                 pool.join()
 
+    # results arrive in the order the books were finished. put them back in
+    # the order they were given to us.
+    return sorted(results, key=lambda _: _[0])
+
+
+def runsharded(jobs, numprocesses, pool=None):
+    """
+    Convert usfm files, splitting large books into shards of chapters.
+
+    jobs are the same as for convertfile. Books with more chapters than
+    the --shard option are converted in this process while the worker pool
+    converts the shards of their chapters along with the other books. If a
+    multiprocessing pool is given it's used instead of creating a new one.
+    Returns the results in the order given.
+
+    """
+    if pool is None:
+        pool = multiprocessing.Pool(numprocesses)
+        try:
+            return runsharded(jobs, numprocesses, pool)
+        finally:
+            pool.close()
+            pool.join()
+
+    # the files are read here to count their chapters.
+    small = []
+    large = []
+    for num, fname, options in jobs:
+        with open(fname, "rb") as ifile:
+            text = ifile.read()
+        if text.count(b"\\c ") > options.shard:
+            large.append((num, text, fname, options))
+        else:
+            small.append((num, text, fname, options))
+
+    # the other books are given to the workers first so that they're kept
+    # busy while the large books are prepared here.
+    pending = pool.map_async(converttext, small, 1)
+    results = [converttext(_, pool) for _ in large]
+    return sorted(results + pending.get(), key=lambda _: _[0])
+
+
+def getbookorder(booklist, sort):
+    """Put a list of book ids in the sort order given with -s."""
+    if sort == "none":
+        bookorder = booklist
+    elif sort == "canonical":
+        bookorder = [_ for _ in CANONICALORDER if _ in booklist]
+    else:
+        with open("order-{}.txt".format(sort), "r") as order:
+            bookorder = order.read()
+            bookorder = [
+                _
+                for _ in bookorder.split("\n")
+                if _ != "" and not _.startswith("#")
+            ]
+        bookorder = [_ for _ in bookorder if _ in booklist]
+    return bookorder
+
+
+def buildosis(results, args, reconvert):
+    """
+    Put the converted books together into an osis doc.
+
+    results are the sorted results from the workers. The doc is validated
+    and pretty printed as requested. Books that were only sent back pretty
+    printed are converted again if the plain doc is written instead.
+    reconvert is called with the positions of those books and returns the
+    results of converting them without pretty printing. (see plainoptions)
+    Returns a generator for the parts of the doc, the converted books, and
+    the profiles for each book.
+
+    """
+    books = {}
+    prettybooks = {}
+    descriptions = {}
+    booklist = []
+    positions = {}
+
+    # get username from operating system
+    username = {True: os.getenv("LOGNAME"), False: os.getenv("USERNAME")}[
+        os.getenv("USERNAME") is None
+    ]
+
     # store results
-    for bookid, descriptiontext, newtext in results:
+    validationerrors = 0
+    cachestats = {"hit": [0, 0], "miss": [0, 0]}
+    profiles = OrderedDict()
+    for num, stats, result, profile in results:
+        bookid, descriptiontext, newtext, prettytext, errors = result
+        if profile is not None:
+            profiles[bookid] = profile
+        if stats is not None:
+            cachestats[stats[0]][0] += 1
+            cachestats[stats[0]][1] += stats[1]
+        # report errors from per book validation
+        for line, message in errors:
+            LOG.error(
+                "Validation failed: %s line %s: %s", bookid, line, message
+            )
+        validationerrors += len(errors)
         # store our converted text for output
         if bookid != "TEST":
-            if bookid in NONCANONICAL:
-                books[bookid] = '<div type="{}">\n{}\n</div>\n\n'.format(
-                    NONCANONICAL[bookid], newtext
-                )
-            else:
-                books[
-                    bookid
-                ] = '<div type="book" osisID="{}" {}>\n{}\n</div>\n\n'.format(
-                    bookid, 'canonical="true"', newtext
-                )
+            books[bookid] = newtext
+            prettybooks[bookid] = prettytext
             descriptions[bookid] = descriptiontext
             booklist.append(bookid)
+            positions[bookid] = num
         else:
             if bookid in books.keys():
                 books[bookid] = "{}\n{}".format(books[bookid], newtext)
@@ -3145,138 +4195,503 @@ def processfiles(args):
             else:
                 books[bookid] = newtext
                 descriptions[bookid] = descriptiontext
+            prettybooks[bookid] = None
             if "TEST" not in booklist:
                 booklist.append("TEST")
 
-    # ## Get order for books...
-    if args.s == "none":
-        tmp = "\n".join([books[_] for _ in booklist])
-        tmp2 = [descriptions[_] for _ in booklist]
-    elif args.s == "canonical":
-        tmp = "\n".join(
-            [books[_] for _ in CANONICALORDER if _ in books.keys()]
-        )
-        tmp2 = [descriptions[_] for _ in CANONICALORDER if _ in books.keys()]
-    else:
-        with open("order-{}.txt".format(args.s), "r") as order:
-            bookorder = order.read()
-            bookorder = [
-                _
-                for _ in bookorder.split("\n")
-                if _ != "" and not _.startswith("#")
-            ]
-        tmp = "\n".join([books[_] for _ in bookorder if _ in books.keys()])
-        tmp2 = [descriptions[_] for _ in bookorder if _ in books.keys()]
-    # check for strongs presence in osis
-    strongsheader = {True: STRONGSWORK, False: ""}["<w " in tmp]
-    # assemble osis doc in desired order
-    osisdoc = "{}{}{}\n".format(
-        OSISHEADER.format(
-            args.workid,
-            args.l,
-            username,
-            datetime.datetime.now().strftime("%Y.%m.%dT%H.%M.%S"),
-            args.workid,
-            args.workid,
-            "\n".join(tmp2),
-            args.l,
-            args.workid,
-            strongsheader,
-        ),
-        tmp,
-        OSISFOOTER,
-    )
+    # the rest of the stages are profiled in this process.
+    if args.profile is not None:
+        enableprofiling()
+
+    if args.cache is not None:
+        LOG.info(
+            "Book cache: %s hits (%s bytes read), %s misses "
+            "(%s bytes written)",
+            cachestats["hit"][0],
+            cachestats["hit"][1],
+            cachestats["miss"][0],
+            cachestats["miss"][1],
+        )
+
+    # ## Get order for books...
+    bookorder = getbookorder(booklist, args.s)
+
+    def getbook(bookid):
+        """Get the plain copy of a book, or the pretty one if that's all."""
+        return {True: prettybooks[bookid], False: books[bookid]}[
+            books[bookid] is None
+        ]
+
+    def plainbooks():
+        """Get the plain copies of the books that were pretty printed."""
+        nums = [positions[_] for _ in bookorder if books[_] is None]
+        if nums:
+            LOG.info("Converting books again without pretty printing...")
+            for _, _, result, _ in reconvert(nums):
+                books[result[0]] = result[2]
+
+    # check for strongs presence in osis
+    strongsheader = {True: STRONGSWORK, False: ""}[
+        any("<w " in getbook(_) for _ in bookorder)
+    ]
+    osisheader = OSISHEADER.format(
+        args.workid,
+        args.l,
+        username,
+        datetime.datetime.now().strftime("%Y.%m.%dT%H.%M.%S"),
+        args.workid,
+        args.workid,
+        "\n".join([descriptions[_] for _ in bookorder]),
+        args.l,
+        args.workid,
+        strongsheader,
+    )
+
+    # apply NFC normalization to header unless explicitly disabled.
+    if not args.n:
+        osisheader = unicodedata.normalize("NFC", osisheader)
+    osisfooter = "{}\n".format(OSISFOOTER)
+
+    def osisparts(pretty=False):
+        """Get the parts of our osis doc in the desired order."""
+        if pretty:
+            # the osis footer is formatted the same way as the end of the
+            # formatted osis header.
+            header = prettyosis(
+                "{}{}".format(osisheader, OSISWRAPPER[1]), wrap=False
+            )
+            yield cleanosis("".join(header[:-2]))
+        else:
+            yield cleanosis(osisheader)
+        for num, bookid in enumerate(bookorder):
+            if pretty:
+                part = prettybooks[bookid]
+                if part is None:
+                    # the book is not well formed xml, so this will raise
+                    # the error from the xml parser.
+                    part = cleanosis("".join(prettyosis(books[bookid])))
+                yield part
+            else:
+                yield "{}{}".format(
+                    {True: "\n", False: ""}[num > 0], getbook(bookid)
+                )
+        if pretty:
+            yield "".join(header[-2:])
+        else:
+            yield osisfooter
+
+    def validate():
+        """Validate our osis doc. Raises XMLSyntaxError if it's not valid."""
+        if args.strict:
+            validateosis(osisparts(), getschema(args.cache))
+        elif None in [prettybooks[_] for _ in bookorder]:
+            # books have already been validated, so we only need to make
+            # sure that the complete doc is well formed. This also finds
+            # the error in a book that isn't.
+            validateosis(osisparts())
+        else:
+            # books have already been validated, and they were pretty
+            # printed by lxml so they're well formed. Only the header needs
+            # to be checked.
+            validateosis(
+                [cleanosis(osisheader), osisfooter], getschema(args.cache)
+            )
+
+    # Print note about references not being processed.
+    LOG.warning("NOTE: References have not been processed.")
+
+    # validate and "pretty print" our osis doc if requested.
+    osisdoc = None
+    if importlxml():
+        # validation is requested...
+        if not args.x:
+            LOG.warning("Validating osis xml...")
+            try:
+                try:
+                    validate()
+                except et.XMLSyntaxError:
+                    if None not in [books[_] for _ in bookorder]:
+                        raise
+                    # find the error again in the plain doc that's written
+                    # instead, so that the line number is right.
+                    plainbooks()
+                    validate()
+                if validationerrors:
+                    LOG.error(
+                        "Validation failed: %s error(s)", validationerrors
+                    )
+                else:
+                    LOG.warning("Validation passed!")
+                    osisdoc = osisparts(pretty=True)
+            except et.XMLSyntaxError as err:
+                LOG.error("Validation failed: %s", str(err))
+        # no validation, just pretty printing...
+        else:
+            # ... but only if we're not debugging.
+            if not args.d:
+                osisdoc = osisparts(pretty=True)
+    else:
+        if not args.x:
+            LOG.error("LXML needs to be installed for validation.")
+
+    # otherwise the plain doc is written.
+    if osisdoc is None:
+        plainbooks()
+        osisdoc = osisparts()
+
+    return osisdoc, books, profiles
+
+
+def processfiles(args, pool=None):
+    """
+    Process usfm files specified on command line.
+
+    If a multiprocessing pool is given it's used to convert the books
+    instead of creating a new one. (used by batch mode)
+
+    """
+    # set number of processes to use while processing file contents. There's
+    # no need for more processes than files.
+    numprocesses = 1
+    if len(args.file) > 1:
+        numprocesses = min(getnumprocesses(args), len(args.file))
+    # (unless large books are split into shards of chapters.)
+    if args.shard is not None:
+        numprocesses = getnumprocesses(args)
+
+    # files are read by the workers. the largest files are converted first
+    # so that a large book isn't left running on its own at the end.
+    filelist = sorted(
+        [(num, fname, args) for num, fname in enumerate(args.file)],
+        key=lambda _: os.path.getsize(_[1]),
+        reverse=True,
+    )
+    # Abort processing if we don't know the encoding of a file.
+    LOG.info("Processing files...")
+    try:
+        if args.shard is not None and (numprocesses > 1 or pool is not None):
+            results = runsharded(filelist, numprocesses, pool)
+        else:
+            results = runworkers(convertfile, filelist, numprocesses, pool)
+    except UnknownEncodingError as err:
+        LOG.error("ERROR: Unknown encoding... aborting conversion.")
+        LOG.error(r"    \ide line for %s says --> %s", *err.args)
+        sys.exit()
+
+    def reconvert(nums):
+        """Convert files again without pretty printing them."""
+        options = plainoptions(args)
+        return runworkers(
+            convertfile,
+            [(_, args.file[_], options) for _ in nums],
+            min(numprocesses, len(nums)),
+            pool,
+        )
+
+    writeresults(results, args, reconvert)
+
+
+def writeresults(results, args, reconvert):
+    """
+    Put the converted books together and write the osis doc.
+
+    The verse table is also written if one was requested. reconvert is
+    passed on to buildosis.
+
+    """
+    if args.verses_only:
+        # (the profiles for each book are usually collected by buildosis.)
+        if args.profile is not None:
+            enableprofiling()
+        profiles = OrderedDict(
+            [(_[2][0], _[3]) for _ in results if _[3] is not None]
+        )
+    else:
+        osisdoc, books, profiles = buildosis(results, args, reconvert)
+
+        # write doc to file
+        outfile = "{}.osis".format(args.workid)
+        if args.o is not None:
+            outfile = args.o
+        usfmtagset = writeosis(outfile, osisdoc)
+
+        if usfmtagset:
+            LOG.warning(
+                "Unhandled USFM Tags: %s", ", ".join(sorted(usfmtagset))
+            )
+
+        if "TEST" in books.keys():
+            print(books["TEST"])
+
+    if args.verses is not None:
+        LOG.info("Writing verse table...")
+        writeverses(args.verses, results, args)
+
+    if args.profile is not None:
+        writeprofile(args.profile, profiles, PROFILE)
+
+
+def watchfiles(args, interval=0.5):
+    """
+    Process usfm files, then process them again whenever they change.
+
+    Only the books that have changed are converted again. The other books
+    are kept in memory and put back together with the changed ones. Unless
+    --strict is given, books are validated separately so unchanged books
+    don't have to be validated again. Files are checked for changes every
+    interval seconds until ctrl-c is pressed. If a book can't be converted
+    the error is reported and the book is kept as it was until it's saved
+    again.
+
+    """
+    numprocesses = getnumprocesses(args)
+    pool = None
+    if numprocesses > 1 and len(args.file) > 1:
+        pool = multiprocessing.Pool(numprocesses, ignoreinterrupts)
+
+    def reconvert(nums):
+        """Convert files again without pretty printing them."""
+        options = plainoptions(args)
+        return runworkers(
+            convertfile,
+            [(_, args.file[_], options) for _ in nums],
+            1,
+            {True: pool, False: None}[len(nums) > 1],
+        )
+
+    results = {}
+    stamps = {}
+    try:
+        while True:
+            # a file is changed if its size or modification time changed.
+            changed = []
+            for num, fname in enumerate(args.file):
+                try:
+                    stat = os.stat(fname)
+                except OSError:
+                    # the file may be in the middle of being saved.
+                    continue
+                if stamps.get(fname) != (stat.st_mtime, stat.st_size):
+                    stamps[fname] = (stat.st_mtime, stat.st_size)
+                    changed.append((num, fname, args))
+
+            if changed:
+                starttime = time.time()
+                if results:
+                    LOG.warning(
+                        "Converting %s...",
+                        ", ".join([_[1] for _ in changed]),
+                    )
+                # the books we had are kept if the changes can't be written.
+                previous = dict(results)
+                try:
+                    converted = 0
+                    for _ in runworkers(
+                        convertchanged,
+                        changed,
+                        1,
+                        {True: pool, False: None}[len(changed) > 1],
+                    ):
+                        if isinstance(_[2], UnknownEncodingError):
+                            LOG.error(
+                                "ERROR: Unknown encoding... skipping changes."
+                            )
+                            LOG.error(
+                                r"    \ide line for %s says --> %s", *_[2].args
+                            )
+                        elif isinstance(_[2], Exception):
+                            LOG.error(
+                                "Conversion failed: %s: %s",
+                                args.file[_[0]],
+                                str(_[2]),
+                            )
+                        else:
+                            results[_[0]] = _
+                            converted += 1
+                    if converted:
+                        writeresults(
+                            [results[_] for _ in sorted(results)],
+                            args,
+                            reconvert,
+                        )
+                        LOG.warning(
+                            "Done in %.2f seconds. Watching for changes...",
+                            time.time() - starttime,
+                        )
+                except Exception as err:  # pylint: disable=broad-except
+                    LOG.error("Conversion failed: %s", str(err))
+                    results = previous
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
 
-    # Print note about references not being processed.
-    LOG.warning("NOTE: References have not been processed.")
+class OptionsParser(argparse.ArgumentParser):
+    """A command line parser that raises ValueError instead of exiting."""
 
-    # apply NFC normalization to text unless explicitly disabled.
-    if not args.n:
-        osisdoc = codecs.encode(unicodedata.normalize("NFC", osisdoc), "utf-8")
-    else:
-        osisdoc = codecs.encode(osisdoc, "utf-8")
+    def error(self, message):
+        raise ValueError(message)
 
-    # validate and "pretty print" our osis doc if requested.
-    if HAVELXML:
-        # a test string allows output to still be generated
-        # even when when validation fails.
-        testosis = SQUEEZE.sub(" ", osisdoc.decode("utf-8"))
 
-        # validation is requested...
-        if not args.x:
-            LOG.warning("Validating osis xml...")
-            osisschema = codecs.decode(
-                codecs.decode(codecs.decode(SCHEMA, "base64"), "bz2"), "utf-8"
-            )
-            try:
-                vparser = et.XMLParser(
-                    schema=et.XMLSchema(et.XML(osisschema)),
-                    remove_blank_text=True,
-                )
-                _ = et.fromstring(testosis.encode("utf-8"), vparser)
-                LOG.warning("Validation passed!")
-                osisdoc = et.tostring(
-                    _,
-                    pretty_print=True,
-                    xml_declaration=True,
-                    encoding="utf-8",
-                )
-            except et.XMLSyntaxError as err:
-                LOG.error("Validation failed: %s", str(err))
-        # no validation, just pretty printing...
-        else:
-            # ... but only if we're not debugging.
-            if not args.d:
-                vparser = et.XMLParser(remove_blank_text=True)
-                _ = et.fromstring(testosis.encode("utf-8"), vparser)
-                osisdoc = et.tostring(
-                    _,
-                    pretty_print=True,
-                    xml_declaration=True,
-                    encoding="utf-8",
-                )
-    else:
-        if not args.x:
-            LOG.error("LXML needs to be installed for validation.")
+class Converter(object):
+    """
+    Convert usfm books to osis in memory.
 
-    # find unhandled usfm tags that are leftover after processing
-    usfmtagset = set()
-    usfmtagset.update(USFMRE.findall(osisdoc.decode("utf-8")))
-    if usfmtagset:
-        LOG.warning("Unhandled USFM Tags: %s", ", ".join(sorted(usfmtagset)))
+    This is for programs that convert many bibles, such as a web service,
+    and want to avoid starting this script and going through files for each
+    one. Books are given as bytes, which are decoded the same way as usfm
+    files, or as strings. options are command line options for a single
+    work, without the work id or files. For example:
 
-    # simple whitespace cleanups before writing to file...
-    osisdoc = osisdoc.decode("utf-8")
-    for i in (
-        (" <note", "<note"),
-        (" </p>", "</p>"),
-        (" </item>", "</item>"),
-        (" </l>", "</l>"),
-        ("</w><w", "</w> <w"),
-    ):
-        osisdoc = osisdoc.replace(i[0], i[1])
-    osisdoc = osisdoc.encode("utf-8")
+        with Converter(["-l", "en", "-b"]) as converter:
+            osis = converter.convert("KJV", [genesis, exodus])
+
+    Compiled regular expressions and the OSIS schema are kept for the
+    life of the process. When more than one worker process is used the
+    worker pool is created on first use and kept until close is called,
+    unless a multiprocessing pool to use instead is given.
+    Problems are reported with the logger of this script, the same as
+    the command line. ValueError is raised if the options aren't valid.
+
+    """
+
+    def __init__(self, options=None, pool=None):
+        # parse the options with a placeholder work id and file.
+        self.args = getparser(OptionsParser).parse_args(
+            ["WORKID"] + list(options or []) + ["FILE"]
+        )
+        self.args.file = []
+        try:
+            self.args = prepareargs(self.args)
+        except SystemExit:
+            # the problem has already been logged.
+            raise ValueError("invalid options: {}".format(options))
+        self.numprocesses = getnumprocesses(self.args)
+        # a pool that we're given is left for its owner to close.
+        self.pool = pool
+        self.ownpool = pool is None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stop the worker pool."""
+        if self.pool is not None and self.ownpool:
+            self.pool.close()
+            self.pool.join()
+        self.pool = None
+
+    def convertbooks(self, texts, names=None, options=None):
+        """
+        Convert books and return the results in the order given.
+
+        names are used in error messages and default to the position of
+        each book. options default to our options. Returns the sorted
+        results from converttext. Raises UnknownEncodingError if the
+        encoding of a book is unknown.
+
+        """
+        if names is None:
+            names = ["book {}".format(_ + 1) for _ in range(len(texts))]
+        if options is None:
+            options = self.args
+        jobs = [
+            (num, text, name, options)
+            for num, (text, name) in enumerate(zip(texts, names))
+        ]
+        # a single book is converted in this process.
+        pool = None
+        if len(jobs) > 1:
+            if self.pool is None and self.numprocesses > 1:
+                self.pool = multiprocessing.Pool(self.numprocesses)
+            pool = self.pool
+        return runworkers(converttext, jobs, 1, pool)
+
+    def fragments(self, texts, names=None):
+        """
+        Convert books to osis fragments.
+
+        Returns a list of (book id, osis) tuples in the order given. The
+        fragments are not validated or pretty printed.
+
+        """
+        return [
+            (_[2][0], _[2][2])
+            for _ in self.convertbooks(texts, names, plainoptions(self.args))
+        ]
 
-    # write doc to file
-    outfile = "{}.osis".format(args.workid)
-    if args.o is not None:
-        outfile = args.o
-    with open(outfile, "wb") as ofile:
-        ofile.write(osisdoc)
+    def convert(self, workid, texts, names=None, lang=None):
+        """
+        Convert books to an osis doc.
+
+        The doc is validated and pretty printed according to our options.
+        lang overrides the langauge code given in our options.
+
+        """
+        args = argparse.Namespace(**vars(self.args))
+        args.workid = workid
+        if lang is not None:
+            args.l = lang
+        if names is None:
+            names = ["book {}".format(_ + 1) for _ in range(len(texts))]
+
+        def reconvert(nums):
+            """Convert books again without pretty printing them."""
+            return self.convertbooks(
+                [texts[_] for _ in nums],
+                [names[_] for _ in nums],
+                plainoptions(args),
+            )
 
-    if "TEST" in books.keys():
-        print(books["TEST"])
+        results = self.convertbooks(texts, names)
+        osisdoc, _, _ = buildosis(results, args, reconvert)
+        return "".join(osisdoc)
 
 
 # -------------------------------------------------------------------------- #
 
 
-def main():
-    """Process command line and pass options to usfm processing routine."""
-    parser = argparse.ArgumentParser(
+def getbookorders():
+    """
+    Get the list of book orders that can be used.
+
+    Book orders are available from external files in the current working
+    directory. Each order file has the following naming pattern:
+        order-SOMEORDER.txt
+
+    """
+    bookorders = sorted(
+        [
+            _.replace("order-", "").replace(".txt", "")
+            for _ in glob.glob("order-*.txt")
+        ]
+    )
+    bookorders.append("none")
+    bookorders.insert(0, "canonical")
+    return bookorders
+
+
+def getparser(parserclass=argparse.ArgumentParser):
+    """
+    Build the command line parser used for converting a single work.
+
+    parserclass is the class of the parser. (see OptionsParser)
+
+    """
+    parser = parserclass(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description="""
             convert USFM bibles to OSIS.
+            (use "%(prog)s batch MANIFEST" to convert several works
+            listed in a manifest file, or "%(prog)s serve" to convert
+            books sent by other programs.)
         """,
         epilog="""
             * Version: {} * {} * This script is public domain. *
@@ -3299,7 +4714,7 @@ def main():
         "-l", help="specify langauge code", metavar="LANG", default="und"
     )
     parser.add_argument(
-        "-s", help="sort order", choices=BOOKORDERS, default="canonical"
+        "-s", help="sort order", choices=getbookorders(), default="canonical"
     )
     parser.add_argument("-v", help="verbose output", action="store_true")
     parser.add_argument(
@@ -3310,19 +4725,117 @@ def main():
     parser.add_argument(
         "-n", help="disable unicode NFC normalization", action="store_true"
     )
+    parser.add_argument(
+        "-b",
+        help="validate each book separately while it's being converted. "
+        "(the default unless --strict is given)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--strict",
+        help="validate the complete OSIS doc in one pass. (slower)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        help="number of worker processes. all cpus are used if not given",
+        type=int,
+        default=None,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--profile",
+        help="write a json report of time spent in each conversion stage",
+        default=None,
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--cache",
+        help="directory used to cache the OSIS schema and converted books",
+        default=None,
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--prune",
+        help="remove cached books that haven't been used for DAYS days",
+        type=float,
+        default=None,
+        metavar="DAYS",
+    )
+    parser.add_argument(
+        "--verses",
+        help="also write a table of verses to FILE. the format is chosen by "
+        "the file extension: .jsonl, .tsv, or .sqlite",
+        default=None,
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--verse-markup",
+        help="include the osis markup of each verse in the verse table",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verses-only",
+        help="write the verse table without the OSIS file",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shard",
+        help="convert books with more than N chapters in shards of N "
+        "chapters at a time, using more than one worker process for them",
+        type=int,
+        default=None,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--watch",
+        help="keep running and convert books again when their files change",
+        action="store_true",
+    )
     parser.add_argument(
         "file",
         help="file or files to process (wildcards allowed)",
         nargs="+",
         metavar="filename",
     )
-    args = parser.parse_args()
+    return parser
+
+
+def prepareargs(args):
+    """
+    Expand file name wildcards and check that input files exist.
+
+    The book cache directory is also created here if it's needed.
+
+    """
+    if args.verses is not None:
+        if os.path.splitext(args.verses)[1].lower() not in VERSEFORMATS:
+            LOG.error(
+                "*** verse tables must be .jsonl, .tsv, or .sqlite files. ***"
+            )
+            sys.exit()
+        # the osis doc isn't validated when it isn't written.
+        if args.verses_only:
+            args.x = True
+    elif args.verses_only or args.verse_markup:
+        LOG.warning(
+            "Note:  --verses-only and --verse-markup have no effect "
+            "without --verses."
+        )
 
     # make sure we skip OSIS validation if we don't have lxml
-    if not args.x and not HAVELXML:
+    if not args.x and not importlxml():
         args.x = True
         LOG.warning("Note:  lxml is not installed. Skipping OSIS validation.")
 
+    if args.prune is not None and args.cache is None:
+        LOG.warning("Note:  --prune has no effect without --cache.")
+
+    # changed books are converted on their own in watch mode.
+    if args.watch and args.shard is not None:
+        LOG.error("*** --shard can't be used with --watch. ***")
+        sys.exit()
+
     filenames = []
     for _ in args.file:
         globfiles = glob.glob(_)
@@ -3342,11 +4855,595 @@ def main():
             LOG.error("*** input file not present or not a normal file. ***")
             sys.exit()
 
+    # make sure our book cache exists before the workers use it.
+    if args.cache is not None:
+        try:
+            os.makedirs(os.path.join(args.cache, "books"))
+        except OSError:
+            pass
+
+    return args
+
+
+def readmanifest(fname):
+    """
+    Read a batch conversion manifest.
+
+    The manifest can be a TOML, JSON, or CSV file. TOML and JSON manifests
+    contain a list of works under the "work" key. (JSON manifests may also
+    be a plain list.) CSV manifests have one work per row with a header
+    row naming the columns.
+
+    Each work has the following keys:
+        workid    - work id to use for OSIS file (required)
+        files     - file or files to process, wildcards allowed (required)
+        lang      - langauge code
+        sort      - sort order
+        output    - output file
+        encoding  - encoding to use for USFM files
+        verses    - verse table to write (see --verses)
+
+    Relative file names are relative to the directory of the manifest.
+
+    """
+    ext = os.path.splitext(fname)[1].lower()
+    try:
+        if ext == ".toml":
+            # (tomllib is only available in python 3.11 and later.)
+            # pylint: disable=import-outside-toplevel
+            try:
+                import tomllib
+            except ImportError:
+                try:
+                    import tomli as tomllib
+                except ImportError:
+                    LOG.error(
+                        "tomllib or tomli is needed to read TOML manifests."
+                    )
+                    sys.exit()
+            with open(fname, "rb") as ifile:
+                works = tomllib.load(ifile).get("work", [])
+        elif ext == ".json":
+            with codecs.open(fname, "r", "utf-8") as ifile:
+                works = json.load(ifile)
+            if isinstance(works, dict):
+                works = works.get("work", [])
+        elif ext == ".csv":
+            with codecs.open(fname, "r", "utf-8-sig") as ifile:
+                works = [
+                    dict([(k.strip(), v.strip()) for k, v in _.items() if k])
+                    for _ in csv.DictReader(ifile)
+                ]
+        else:
+            LOG.error("Unknown manifest format: %s", fname)
+            sys.exit()
+    except (IOError, OSError, ValueError) as err:
+        LOG.error("Unable to read manifest %s: %s", fname, str(err))
+        sys.exit()
+
+    # resolve file names relative to the manifest location
+    basedir = os.path.dirname(os.path.abspath(fname))
+    for work in works:
+        for key in ["files", "output", "verses"]:
+            if key not in work or not work[key]:
+                continue
+            if key == "files" and not isinstance(work[key], list):
+                work[key] = [work[key]]
+            if key == "files":
+                work[key] = [os.path.join(basedir, _) for _ in work[key]]
+            else:
+                work[key] = os.path.join(basedir, work[key])
+
+    return works
+
+
+def batchmain(argv):
+    """Convert all works listed in a manifest in a single process."""
+    parser = argparse.ArgumentParser(
+        prog="{} batch".format(os.path.basename(sys.argv[0])),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+            convert several USFM bibles to OSIS using a manifest.
+        """,
+        epilog=readmanifest.__doc__.split("\n\n", 1)[1],
+    )
+    parser.add_argument(
+        "manifest", help="TOML, JSON, or CSV manifest of works to convert"
+    )
+    parser.add_argument("-d", help="debug mode", action="store_true")
+    parser.add_argument("-v", help="verbose output", action="store_true")
+    parser.add_argument(
+        "-x",
+        help="disable OSIS validation and reformatting",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-n", help="disable unicode NFC normalization", action="store_true"
+    )
+    parser.add_argument(
+        "-b",
+        help="validate each book separately while it's being converted. "
+        "(the default unless --strict is given)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--strict",
+        help="validate the complete OSIS doc in one pass. (slower)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        help="number of worker processes. all cpus are used if not given",
+        type=int,
+        default=None,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--cache",
+        help="directory used to cache the OSIS schema and converted books",
+        default=None,
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--prune",
+        help="remove cached books that haven't been used for DAYS days",
+        type=float,
+        default=None,
+        metavar="DAYS",
+    )
+    batchargs = parser.parse_args(argv)
+
+    if batchargs.v:
+        LOG.setLevel(logging.INFO)
+    if batchargs.d:
+        LOG.setLevel(logging.DEBUG)
+
+    works = readmanifest(batchargs.manifest)
+
+    # common options for every work in the manifest
+    options = []
+    for _ in ["d", "x", "n", "b"]:
+        if getattr(batchargs, _):
+            options.append("-{}".format(_))
+    if batchargs.strict:
+        options.append("--strict")
+    if batchargs.cache is not None:
+        options.extend(["--cache", batchargs.cache])
+
+    # one worker pool is shared by all works
+    numprocesses = getnumprocesses(batchargs)
+    pool = None
+    if numprocesses > 1:
+        pool = multiprocessing.Pool(numprocesses)
+
+    workparser = getparser()
+    timings = []
+    failed = 0
+    batchstart = time.time()
+    try:
+        for work in works:
+            if not work.get("workid") or not work.get("files"):
+                LOG.error("Skipping work without workid or files: %s", work)
+                failed += 1
+                continue
+            workargv = [work["workid"]] + options
+            for key, opt in [
+                ("lang", "-l"),
+                ("sort", "-s"),
+                ("output", "-o"),
+                ("encoding", "-e"),
+                ("verses", "--verses"),
+            ]:
+                if work.get(key):
+                    workargv.extend([opt, work[key]])
+            workargv.extend(work["files"])
+
+            LOG.warning("Converting %s...", work["workid"])
+            starttime = time.time()
+            numfiles = 0
+            status = "ok"
+            try:
+                args = prepareargs(workparser.parse_args(workargv))
+                numfiles = len(args.file)
+                processfiles(args, pool)
+            except SystemExit:
+                status = "failed"
+                LOG.error("Conversion of %s failed.", work["workid"])
+            except Exception as err:  # pylint: disable=broad-except
+                status = "failed"
+                LOG.error(
+                    "Conversion of %s failed: %s", work["workid"], str(err)
+                )
+            if status == "failed":
+                failed += 1
+            timings.append(
+                (work["workid"], numfiles, time.time() - starttime, status)
+            )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if batchargs.prune is not None and batchargs.cache is not None:
+        prunecache(batchargs.cache, batchargs.prune, batchstart)
+
+    # summary of per-work timings
+    summary = "{:<20} {:>6} {:>10}  {}"
+    print(summary.format("workid", "files", "seconds", "status"))
+    for _ in timings:
+        print(summary.format(_[0], _[1], "{:.2f}".format(_[2]), _[3]))
+    print(
+        summary.format(
+            "total",
+            sum([_[1] for _ in timings]),
+            "{:.2f}".format(sum([_[2] for _ in timings])),
+            "",
+        )
+    )
+
+    if failed:
+        sys.exit(1)
+
+
+def ignoreinterrupts():
+    """Leave ctrl-c to the server process. (used by the worker processes)"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def servemain(argv):
+    """Convert usfm sent over a local socket using warm worker processes."""
+    # the server modules are only needed here.
+    # pylint: disable=import-outside-toplevel,too-many-locals
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn, UnixStreamServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn, UnixStreamServer
+
+    parser = argparse.ArgumentParser(
+        prog="{} serve".format(os.path.basename(sys.argv[0])),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+            convert USFM bibles to OSIS for other programs over HTTP on
+            localhost or a unix socket.
+        """,
+        epilog="""
+requests:
+    POST /convert   convert books. the request is a json object with:
+                        workid    - work id to use for OSIS file (required)
+                        books     - list of usfm books (required)
+                        names     - names of the books for error messages
+                        options   - list of u2o.py options that change
+                                    the output. only -l, -e, -s, -n, -x,
+                                    -b and --strict can be used
+                        fragments - if true, return a json list of book
+                                    ids and osis for each book instead
+                                    of an osis doc
+    GET /stats      queue depth and latency counters as json
+""",
+    )
+    parser.add_argument(
+        "--port",
+        help="localhost port to listen on",
+        type=int,
+        default=8390,
+    )
+    parser.add_argument(
+        "--socket",
+        help="listen on this unix socket instead of a port",
+        default=None,
+        metavar="PATH",
+    )
+    parser.add_argument("-d", help="debug mode", action="store_true")
+    parser.add_argument("-v", help="verbose output", action="store_true")
+    parser.add_argument(
+        "-j",
+        help="number of worker processes. all cpus are used if not given",
+        type=int,
+        default=None,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--concurrent",
+        help="number of requests to convert at the same time",
+        type=int,
+        default=2,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--queue",
+        help="number of requests that can wait to be converted",
+        type=int,
+        default=16,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--cache",
+        help="directory used to cache the OSIS schema and converted books",
+        default=None,
+        metavar="DIR",
+    )
+    serveargs = parser.parse_args(argv)
+
+    if serveargs.v:
+        LOG.setLevel(logging.INFO)
+    if serveargs.d:
+        LOG.setLevel(logging.DEBUG)
+
+    # compile our regular expressions and the OSIS schema before the
+    # workers are started so that none of them has to do it later.
+    for _ in list(globals().values()):
+        if isinstance(_, LazyRegex):
+            getattr(_, "search")
+    if importlxml():
+        getschema(serveargs.cache)
+    numprocesses = getnumprocesses(serveargs)
+    pool = None
+    if numprocesses > 1:
+        pool = multiprocessing.Pool(numprocesses, ignoreinterrupts)
+
+    # the options that requests can use, and whether each one takes a
+    # value. everything else, such as --cache and -j, comes from our own
+    # options.
+    requestoptions = {
+        "-l": True,
+        "-e": True,
+        "-s": True,
+        "-n": False,
+        "-x": False,
+        "-b": False,
+        "--strict": False,
+    }
+
+    # converters for each set of options that we've been sent.
+    converters = {}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(max(serveargs.concurrent, 1))
+    stats = OrderedDict(
+        [
+            ("queued", 0),
+            ("active", 0),
+            ("maxqueue", serveargs.queue),
+            ("concurrent", serveargs.concurrent),
+            ("workers", numprocesses),
+            ("requests", 0),
+            ("rejected", 0),
+            ("failed", 0),
+            ("books", 0),
+            ("seconds", 0.0),
+            ("maxseconds", 0.0),
+            ("lastseconds", 0.0),
+        ]
+    )
+
+    def checkoptions(options):
+        """Check that request options are ones that requests can use."""
+        i = 0
+        while i < len(options):
+            if options[i] not in requestoptions:
+                return False
+            if requestoptions[options[i]]:
+                i += 1
+                if i == len(options) or options[i].startswith("-"):
+                    return False
+            i += 1
+        return True
+
+    def checkrequest(request):
+        """Get what's wrong with a request, or None if there's nothing."""
+        # (strings from json are unicode in python 2.)
+        string = type("")
+        if (
+            not isinstance(request, dict)
+            or "workid" not in request
+            or "books" not in request
+        ):
+            return "workid and books are required"
+        if not isinstance(request["workid"], string):
+            return "workid must be a string"
+        for key in ["books", "names", "options"]:
+            if request.get(key) is None and key != "books":
+                continue
+            if not isinstance(request[key], list) or not all(
+                isinstance(_, string) for _ in request[key]
+            ):
+                return "{} must be a list of strings".format(key)
+        names = request.get("names")
+        if names is not None and len(names) != len(request["books"]):
+            return "names must have one name for each book"
+        return None
+
+    def getconverter(options):
+        """Get the converter for a set of request options."""
+        key = tuple(options)
+        with lock:
+            if key not in converters:
+                # requests use our worker pool, or none if we have none.
+                options = options + ["-j", str(numprocesses)]
+                if serveargs.cache is not None:
+                    options = options + ["--cache", serveargs.cache]
+                converters[key] = Converter(options, pool)
+            return converters[key]
+
+    def convert(request):
+        """Convert a request and return the status, content type and body."""
+        problem = checkrequest(request)
+        if problem is not None:
+            return 400, "text/plain", problem
+        workid = request["workid"]
+        books = request["books"]
+        options = request.get("options") or []
+        if not checkoptions(options):
+            return 400, "text/plain", "invalid options: {}".format(options)
+        try:
+            converter = getconverter(options)
+        except ValueError:
+            return 400, "text/plain", "invalid options: {}".format(options)
+        try:
+            if request.get("fragments"):
+                body = json.dumps(
+                    [
+                        OrderedDict([("bookid", _[0]), ("osis", _[1])])
+                        for _ in converter.fragments(
+                            books, request.get("names")
+                        )
+                    ]
+                )
+                return 200, "application/json", body
+            return (
+                200,
+                "application/xml",
+                converter.convert(workid, books, request.get("names")),
+            )
+        except UnknownEncodingError as err:
+            return 400, "text/plain", "unknown encoding: {}".format(err)
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        """Handle requests from other programs."""
+
+        def address_string(self):
+            # unix sockets don't have a client address.
+            if not self.client_address:
+                return "local"
+            return self.client_address[0]
+
+        def log_message(self, format, *args):
+            # pylint: disable=redefined-builtin
+            LOG.info("%s %s", self.address_string(), format % args)
+
+        def reply(self, status, contenttype, body):
+            """Send a response."""
+            body = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header(
+                "Content-Type", "{}; charset=utf-8".format(contenttype)
+            )
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            """Send our counters."""
+            # pylint: disable=invalid-name
+            if self.path != "/stats":
+                self.reply(404, "text/plain", "not found")
+                return
+            with lock:
+                body = json.dumps(stats, indent=2)
+            self.reply(200, "application/json", body)
+
+        def do_POST(self):
+            """Convert books."""
+            # pylint: disable=invalid-name
+            if self.path != "/convert":
+                self.reply(404, "text/plain", "not found")
+                return
+            starttime = timeit.default_timer()
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length).decode("utf-8"))
+            except ValueError:
+                self.reply(400, "text/plain", "request is not valid json")
+                return
+
+            # turn requests away when the queue is full.
+            with lock:
+                stats["requests"] += 1
+                full = stats["queued"] >= serveargs.queue
+                if full:
+                    stats["rejected"] += 1
+                else:
+                    stats["queued"] += 1
+            if full:
+                self.reply(503, "text/plain", "queue is full")
+                return
+
+            status = 500
+            with slots:
+                with lock:
+                    stats["queued"] -= 1
+                    stats["active"] += 1
+                try:
+                    status, contenttype, body = convert(request)
+                except Exception as err:  # pylint: disable=broad-except
+                    LOG.error("Conversion failed: %s", str(err))
+                    contenttype, body = "text/plain", "conversion failed"
+                finally:
+                    seconds = timeit.default_timer() - starttime
+                    with lock:
+                        stats["active"] -= 1
+                        if status != 200:
+                            stats["failed"] += 1
+                        else:
+                            stats["books"] += len(request["books"])
+                        stats["seconds"] += seconds
+                        stats["maxseconds"] = max(stats["maxseconds"], seconds)
+                        stats["lastseconds"] = seconds
+            self.reply(status, contenttype, body)
+
+    if serveargs.socket is not None:
+
+        class Server(ThreadingMixIn, UnixStreamServer):
+            """Threaded HTTP server on a unix socket."""
+
+            daemon_threads = True
+
+        if os.path.exists(serveargs.socket):
+            os.remove(serveargs.socket)
+        server = Server(serveargs.socket, RequestHandler)
+        address = serveargs.socket
+    else:
+
+        class Server(ThreadingMixIn, HTTPServer):
+            """Threaded HTTP server on localhost."""
+
+            daemon_threads = True
+
+        server = Server(("127.0.0.1", serveargs.port), RequestHandler)
+        address = "http://127.0.0.1:{}/".format(serveargs.port)
+
+    LOG.warning(
+        "Listening on %s with %s worker process(es)...",
+        address,
+        numprocesses,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if serveargs.socket is not None and os.path.exists(serveargs.socket):
+            os.remove(serveargs.socket)
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def main():
+    """Process command line and pass options to usfm processing routine."""
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        batchmain(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        servemain(sys.argv[2:])
+        return
+
+    args = prepareargs(getparser().parse_args())
+
     if args.v:
         LOG.setLevel(logging.INFO)
     if args.d:
         LOG.setLevel(logging.DEBUG)
-    processfiles(args)
+    starttime = time.time()
+    if args.watch:
+        watchfiles(args)
+    else:
+        processfiles(args)
+
+    if args.prune is not None and args.cache is not None:
+        prunecache(args.cache, args.prune, starttime)
 
 
 # -------------------------------------------------------------------------- #